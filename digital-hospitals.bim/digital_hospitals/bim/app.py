@@ -1,33 +1,85 @@
 """FastAPI module for the BIM service."""
 
+import hashlib
 import importlib.metadata
-import json
+import logging
+import os
 import tempfile
-from datetime import datetime
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from pathlib import Path
 from typing import Annotated, Literal, Optional, Sequence
 
-import networkx as ntx
+import numpy as np
 from bson import ObjectId
-from fastapi import BackgroundTasks, Depends, FastAPI, File, Form, HTTPException, Query, UploadFile, status
+from fastapi import (BackgroundTasks, Depends, FastAPI, File, Form, HTTPException, Query,
+                     Request, UploadFile, status)
+from fastapi.concurrency import run_in_threadpool
 from fastapi.openapi.docs import get_swagger_ui_html
-from pydantic import BaseModel, JsonValue
-from pymongo import MongoClient, ReturnDocument
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, JsonValue, ValidationError
+from pymongo import ReturnDocument
 from pymongo.database import Database
 
 import digital_hospitals.bim
-from digital_hospitals.bim import models
-from digital_hospitals.common import (MONGODB_PASSWORD, MONGODB_PORT, MONGODB_TIMEOUT,
-                                      MONGODB_URL, MONGODB_USER, check_docker)
+from digital_hospitals.bim import db as bim_db
+from digital_hospitals.bim import metrics, models, tasks
+from digital_hospitals.bim.cache import default_cache
+from digital_hospitals.bim.events import KEEP_ALIVE, LATEST, notifier, sse
+from digital_hospitals.bim.lazy import lazy_import, warm_up
+from digital_hospitals.bim.tiles import default_tile_size
+from digital_hospitals.common import check_docker
+
+ntx = lazy_import('networkx')
+
+logger = logging.getLogger(__name__)
 
 # TODO: how to get consistent versioning across all subprojects?
 version = importlib.metadata.version('digital_hospitals.bim')
 
 
+def env_flag(name: str) -> bool:
+    """Whether an environment variable is set to a true value: "1", "true", "yes" or "on"."""
+    return os.environ.get(name, '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# If set, split computations into tasks for `digital_hospitals.bim.worker` processes
+# instead of running them in the API process
+distributed = env_flag('BIM_DISTRIBUTED')
+
+# Uploaded IFC files are written here until their job has parsed them
+SPOOL_DIR = Path(os.environ.get('BIM_SPOOL_DIR', Path(tempfile.gettempdir()) / 'bim-spool'))
+
+DISTANCE_FIELDS_MAX_BYTES = int(os.environ.get('BIM_DISTANCE_MAX_BYTES', 256 << 20))
+"""Memory budget for the distance fields kept for `/distance` queries (256 MiB by default)."""
+
+SPOOL_MAX_AGE_SECONDS = 3600
+"""Age after which spooled files are deleted on startup, having been left behind by a previous
+run of the API, e.g. one killed while its jobs were parsing them."""
+
+UPLOAD_CHUNK_SIZE = 1 << 20
+"""Size of the chunks in which uploaded files are copied to the spool directory (1 MiB)."""
+
+# If set, import the geometry and graph libraries in the background on startup,
+# so that the first job does not have to wait for them
+warm_up_on_startup = env_flag('BIM_WARM_UP')
+
+
 def now() -> float:
     """The current UNIX timestamp."""
     return datetime.now().timestamp()
 
 
+def finished_fields() -> dict:
+    """Fields recording when a job finished: `finished_ts` as a UNIX timestamp, and
+    `finished_at` as a date for the retention policy of `bim_db.ensure_indexes()`."""
+    finished_at = datetime.now(timezone.utc)
+    return {'finished_ts': finished_at.timestamp(), 'finished_at': finished_at}
+
+
 DESCRIPTION = """\
 FastAPI service for the BIM module of the digital hospitals platform. Computes runner times for a
 histopathology lab process model given an .ifc file representing the lab's physical layout.
@@ -35,10 +87,15 @@ histopathology lab process model given an .ifc file representing the lab's physi
 [Return to developer portal frontpage](/dev)
 """
 
-EXAMPLE_GRAPH = ntx.Graph()
-EXAMPLE_GRAPH.add_node("1")
-EXAMPLE_GRAPH.add_node("2")
-EXAMPLE_GRAPH.add_edge("1", "2", weight=10.0)
+# Node-link representation of a graph with two nodes and one edge. Written out rather than built
+# with networkx, so that importing this module does not load networkx.
+EXAMPLE_GRAPH = {
+    "directed": False,
+    "multigraph": False,
+    "graph": {},
+    "nodes": [{"id": "1"}, {"id": "2"}],
+    "links": [{"weight": 10.0, "source": "1", "target": "2"}]
+}
 
 
 class BimResult(BaseModel):
@@ -52,6 +109,21 @@ class BimResult(BaseModel):
     err_msg: Optional[str] = None
     """If `status` is "error", the error message."""
 
+    progress: Optional[float] = None
+    """If `status` is "Running", the fraction of the computation completed so far,
+    between 0 and 1."""
+
+    model_id: Optional[str] = None
+    """If `status` is "OK", the ID of the BIM model the result was computed from."""
+
+    reused_floors: Optional[Sequence[str]] = None
+    """If `status` is "OK", the floors whose runner times were reused from an earlier job
+    rather than recomputed, because their walls and doors had not changed."""
+
+    cache_key: Optional[str] = None
+    """SHA-256 hash of the uploaded IFC file. Used as the ID of the parsed BIM model, so that
+    uploading the same file again does not parse it again."""
+
     requested_ts: float
     """A timestamp denoting when the computation request was received."""
 
@@ -60,7 +132,7 @@ class BimResult(BaseModel):
             "examples": [
                 {
                     "status": "OK",
-                    "graph": ntx.node_link_data(EXAMPLE_GRAPH),
+                    "graph": EXAMPLE_GRAPH,
                     "timestamp": datetime.fromisoformat("2024-06-01T12:34:56+01:00"),
                 }
             ]
@@ -79,96 +151,261 @@ class BimRequestParams(BaseModel):
     via lift or stairs."""
 
 
+STALE_JOB_MESSAGE = 'The job did not finish, e.g. because the BIM service was restarted'
+
+
+def fail_stale_jobs(db: Database, max_age: float = tasks.JOB_TIMEOUT_SECONDS):
+    """Mark the jobs running for more than `max_age` seconds as failed. These were left running
+    by an API process that stopped before they finished; once failed, they expire with the
+    other finished jobs and are no longer counted in the queue depth."""
+    db['results'].update_many(
+        {'status': 'Running', 'requested_ts': {'$lt': now() - max_age}},
+        {'$set': {'status': 'Error', 'err_msg': STALE_JOB_MESSAGE, 'progress': None,
+                  **finished_fields()}}
+    )
+
+
+def prepare_db():
+    """Create the indexes used by the API and the task queue, fail the jobs left running by
+    earlier processes and delete their tasks, and delete unused models."""
+    client = bim_db.connect()
+    try:
+        db = client[bim_db.DB_NAME]
+        for step in (bim_db.ensure_indexes, tasks.ensure_indexes, fail_stale_jobs,
+                     tasks.delete_orphaned, bim_db.expire_unused):
+            try:
+                step(db)
+            except Exception:  # pylint: disable=broad-exception-caught
+                # The database may not be up yet; this is done again on the next startup
+                logger.exception('Could not prepare the database (%s)', step.__name__)
+    finally:
+        client.close()
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    """Startup and shutdown of the API."""
+    if warm_up_on_startup:
+        threading.Thread(target=warm_up, daemon=True).start()
+    threading.Thread(target=prepare_db, daemon=True).start()
+    clean_spool()
+    yield
+
+
 api = FastAPI(
     title='BIM (Building Information Modelling) server',
     description=DESCRIPTION,
     version=version,
     docs_url=None,  # Use custom_swagger_ui_html()
-    redoc_url=None
+    redoc_url=None,
+    lifespan=lifespan
 )
 
 
+@api.middleware('http')
+async def record_latency(request: Request, call_next):
+    """Record the latency of requests to the endpoints in `metrics.TRACKED_PATHS`."""
+    start = time.perf_counter()
+    response = await call_next(request)
+    path = request.url.path.removeprefix(request.scope.get('root_path', ''))
+    if path in metrics.TRACKED_PATHS:
+        metrics.latency.record(path, time.perf_counter() - start)
+    return response
+
+
 def get_db():  # Dependency
     """Get a connection nto the MongoDB server and point it to the 'bim' database."""
+    client = None
     try:
-        client = MongoClient(MONGODB_URL, MONGODB_PORT, username=MONGODB_USER,
-                             password=MONGODB_PASSWORD, timeoutMS=MONGODB_TIMEOUT)
-        yield client['bim']
+        client = bim_db.connect()
+        yield client[bim_db.DB_NAME]
     except HTTPException as exc:
         raise exc
     except Exception as exc:
         raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, str(exc)) from exc
     finally:
-        client.close()
-
-
-def handle_bim_request(file: UploadFile,
+        if client is not None:
+            client.close()
+
+
+PROGRESS_STEP = 0.01
+"""Minimum increase in job progress before the job document is updated."""
+
+
+def clean_spool(max_age: float = SPOOL_MAX_AGE_SECONDS):
+    """Delete the files in the spool directory last modified more than `max_age` seconds ago."""
+    if not SPOOL_DIR.is_dir():
+        return
+    cutoff = time.time() - max_age
+    for path in SPOOL_DIR.glob('*.ifc'):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def spool_upload(file: UploadFile) -> tuple[Path, str]:
+    """Copy an uploaded file to the spool directory in fixed-size chunks, computing its
+    SHA-256 hash in the same pass, so that memory use does not depend on the file size.
+
+    Starlette has already spooled the multipart body to a temporary file (in memory up to
+    1 MiB), so large uploads are written to disk twice. The copy is still needed since
+    `ifcopenshell.open()` takes a path, and Starlette's temporary file has none and is closed
+    once the response is sent, before the background task parses it.
+
+    Returns:
+        The path of the spooled file and its hash.
+    """
+    SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, path = tempfile.mkstemp(dir=SPOOL_DIR, suffix='.ifc')
+    try:
+        with os.fdopen(fd, 'wb') as spool_file:
+            while chunk := file.file.read(UPLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+                spool_file.write(chunk)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return Path(path), digest.hexdigest()
+
+
+def handle_bim_request(path: Path,
+                       cache_key: str,
                        params: BimRequestParams,
-                       _id: ObjectId,
-                       db: Annotated[Database, Depends(get_db)]):
-    """Compute runner times for a given input."""
-    # FIXME: This function doesn't seem to run and/or update the database???
+                       _id: ObjectId):
+    """Compute runner times for a given input. The input file at `path` is deleted once it
+    has been parsed."""
+    # Background tasks run after the request's dependencies have been closed,
+    # so open a dedicated database connection.
+    client = bim_db.connect()
+    db = client[bim_db.DB_NAME]
+    job_key = str(_id)
+
+    last_progress = 0.0
+
+    def report_progress(fraction: float):
+        nonlocal last_progress
+        if fraction - last_progress < PROGRESS_STEP:
+            return
+        last_progress = fraction
+        try:
+            db['results'].update_one({'_id': _id, 'status': 'Running'},
+                                     {'$set': {'progress': fraction}})
+            notifier.publish(job_key)
+        except Exception:
+            pass  # Progress reporting must never fail the job
+
+    # Duration of each stage of the job, for the /metrics endpoint
+    timings = {}
 
-    # Since `ifcopenshell.open()` expects a filename rather than a file object,
-    # create a temp file. This file is deleted automatically on close (default behaviour).
     try:
-        with tempfile.NamedTemporaryFile() as temp_file:
-            # Write file and reset pointer
-            temp_file.write(file)
-            temp_file.seek(0)
-
-            model = models.BimModel.from_ifc(temp_file.name)
-            g = models.logical_graph(
-                model,
-                params.door_list,
-                params.extra_paths,
-                models.DEFAULT_RUNNER_SPEED
-            )
-            status = 'OK'
-            graph = ntx.node_link_data(g)
+        # Reuse the parsed model if the same file was uploaded before
+        model_id = cache_key
+        try:
+            with metrics.timed(timings, 'parse'):
+                try:
+                    model = bim_db.load_model(db, model_id)
+                    is_new_model = False
+                except KeyError:
+                    model = models.BimModel.from_ifc(str(path))
+                    is_new_model = True
+        finally:
+            path.unlink(missing_ok=True)
+
+        if is_new_model:
+            with metrics.timed(timings, 'store_model'):
+                model = bim_db.store_model(db, model_id, model)
+
+        # Reuse the logical graphs of floors unchanged since an earlier job
+        floor_keys = {
+            level: models.floor_digest(model, level, params.door_list,
+                                       models.DEFAULT_RUNNER_SPEED)
+            for level in models.included_levels(model, params.door_list)
+        }
+        floor_graphs = bim_db.load_floor_graphs(db, floor_keys)
+
+        def store_floor(level: str, floor_graph: ntx.Graph):
+            bim_db.store_floor_graph(db, floor_keys[level], floor_graph)
+
+        with metrics.timed(timings, 'compute'):
+            if distributed:
+                g = tasks.logical_graph(
+                    db,
+                    job_key,
+                    model_id,
+                    model,
+                    params.door_list,
+                    params.extra_paths,
+                    models.DEFAULT_RUNNER_SPEED,
+                    progress=report_progress,
+                    floor_graphs=floor_graphs,
+                    on_floor=store_floor
+                )
+            else:
+                g = models.logical_graph(
+                    model,
+                    params.door_list,
+                    params.extra_paths,
+                    models.DEFAULT_RUNNER_SPEED,
+                    progress=report_progress,
+                    cache=default_cache(),
+                    tile_size=default_tile_size(),
+                    floor_graphs=floor_graphs,
+                    on_floor=store_floor
+                )
+        status = 'OK'
+        graph = ntx.node_link_data(g)
     except Exception as exc:
         status = 'Error'
         err_msg = str(exc)
 
-    # Write result to DB -- there should always be at most one document in this collection,
-    # i.e. the latest BIM module result.
+    # Write result to DB
     try:
         if status == 'OK':
             # Write the result to "collection"
             item = db['results'].find_one_and_update(
                 {'_id': _id},
-                {'$set': {'status': status, 'result': graph}},
+                {'$set': {'status': status, 'graph': graph, 'progress': None,
+                          'model_id': model_id, 'reused_floors': list(floor_graphs),
+                          'timings': timings, **finished_fields()}},
                 return_document=ReturnDocument.AFTER
             )
+            notifier.publish(job_key)
 
         elif status == 'Error':
             # Write only the status to "collection" and return early
             db['results'].find_one_and_update(
                 {'_id': _id},
-                {'$set': {'status': status, 'err_msg': err_msg}}
+                {'$set': {'status': status, 'err_msg': err_msg, 'progress': None,
+                          'timings': timings, **finished_fields()}}
             )
+            notifier.publish(job_key)
             return
 
         # Strip MongoDB internal _id field
         if '_id' in item:
             del item['_id']
-            item = BimResult.model_validate(item)
-
-        old_item = db['results-latest'].find_one()  # Get the previous "latest" result
-
-        if old_item is None:  # No previous result found: write new result to "latest"
-            db['results-latest'].insert_one(item)
-
-        else:
-            old_item = BimResult.model_validate(old_item)
-            if old_item.requested_ts >= item.requested_ts:
-                return  # Old result is newer(!!): ignore new result
-
-            # Default behaviour: write new result to "latest"
-            db['results-latest'].find_one_and_replace({}, item)
-
-    except Exception:
-        pass
+        item = BimResult.model_validate(item)
+
+        # There should always be at most one document in "results-latest", i.e. the latest BIM
+        # module result. It is only replaced if this job was requested after the stored one.
+        if bim_db.update_latest(db, item.model_dump()):
+            notifier.publish(LATEST)
+            try:
+                distance_fields.warm_up(model_id, model, graph)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception('Could not compute the distance fields of job %s', job_key)
+
+    except Exception:  # pylint: disable=broad-exception-caught
+        logger.exception('Could not store the result of job %s', job_key)
+    finally:
+        try:
+            bim_db.expire_unused(db)
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception('Could not delete unused models')
+        client.close()
 
 
 @api.get('/latest',
@@ -194,6 +431,227 @@ def get_latest(db: Annotated[Database, Depends(get_db)]) -> BimResult:
     return validated_result
 
 
+class DistancePoint(BaseModel):
+    """A position on a floor of the BIM model."""
+    floor: str
+    x: float
+    y: float
+
+
+class DistanceRequest(BaseModel):
+    """A batch of positions to compute runner times from."""
+    points: Sequence[DistancePoint]
+
+
+class DistanceResult(BaseModel):
+    """Runner times from a batch of positions to each door in the latest result."""
+
+    doors: Sequence[str]
+    """The doors of the latest result."""
+
+    times: Sequence[Sequence[Optional[float]]]
+    """`times[i][k]` is the runner time in seconds from the i-th position to `doors[k]`, or null
+    if the door cannot be reached from the position (e.g. the position is in a wall or outside
+    the floor, or no path of the latest result leads to the door)."""
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [{"doors": ["D1", "D2"], "times": [[4.2, 12.5], [None, 3.1]]}]
+        }
+    }
+
+
+class DistanceFieldsTooLarge(Exception):
+    """The distance fields of a floor would not fit in `DISTANCE_FIELDS_MAX_BYTES`."""
+
+
+class DistanceFieldsCache:
+    """Distance fields of the floors of stored models, kept in memory (or memory-mapped from the
+    grid cache) for repeated `/distance` queries. The least recently used fields are dropped
+    when their total size exceeds `max_bytes`."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._fields: OrderedDict[tuple, models.DistanceFields] = OrderedDict()
+        self._bytes = 0
+        self._computing: dict[tuple, threading.Lock] = {}
+
+    def get(self,
+            model_id: str,
+            floor: str,
+            doors: tuple[str, ...],
+            model: Optional[models.BimModel] = None) -> models.DistanceFields:
+        """Distance fields for the given doors on a floor of a stored model (loaded from the
+        database unless `model` is given). Concurrent calls for the same floor compute the
+        fields only once.
+
+        Raises:
+            DistanceFieldsTooLarge: If the fields would take more than `max_bytes`.
+        """
+        key = (model_id, floor, doors)
+        with self._lock:
+            if key in self._fields:
+                self._fields.move_to_end(key)
+                return self._fields[key]
+            computing = self._computing.setdefault(key, threading.Lock())
+
+        with computing:
+            with self._lock:
+                if key in self._fields:  # Computed by another thread in the meantime
+                    return self._fields[key]
+            try:
+                fields = self._compute(model_id, floor, doors, model)
+            finally:
+                with self._lock:
+                    self._computing.pop(key, None)
+
+            with self._lock:
+                self._fields[key] = fields
+                self._bytes += sum(f.nbytes for f in fields.fields)
+                while self._bytes > self.max_bytes and len(self._fields) > 1:
+                    _, evicted = self._fields.popitem(last=False)
+                    self._bytes -= sum(f.nbytes for f in evicted.fields)
+            return fields
+
+    def _compute(self,
+                 model_id: str,
+                 floor: str,
+                 doors: tuple[str, ...],
+                 model: Optional[models.BimModel]) -> models.DistanceFields:
+        if model is None:
+            client = bim_db.connect()
+            try:
+                model = bim_db.load_model(client[bim_db.DB_NAME], model_id)
+            finally:
+                client.close()
+        s_model = models.ShapelyModel(model, level=floor, include_doors=doors,
+                                      cache=default_cache())
+
+        # One float32 array covering the floor grid per door
+        n_x, n_y = s_model.floor_grid().shape
+        size = n_x * n_y * 4 * len(s_model.door_shapes)
+        if size > self.max_bytes:
+            raise DistanceFieldsTooLarge(
+                f'The distance fields of floor {floor} need {size / 2**20:.0f} MiB, more than '
+                f'the {self.max_bytes / 2**20:.0f} MiB allowed by BIM_DISTANCE_MAX_BYTES')
+        return models.DistanceFields.from_model(s_model)
+
+    def warm_up(self, model_id: str, model: models.BimModel, graph: JsonValue):
+        """Compute the distance fields for `/distance` queries on a new latest result now,
+        rather than in the first query."""
+        doors = latest_doors(model, graph)
+        for floor in models.included_levels(model, doors):
+            try:
+                self.get(model_id, floor, doors, model)
+            except DistanceFieldsTooLarge:
+                pass  # Reported when queried
+
+
+distance_fields = DistanceFieldsCache(DISTANCE_FIELDS_MAX_BYTES)
+"""Distance fields for the `/distance` endpoints."""
+
+
+_door_times_lock = threading.Lock()
+_door_times: dict[tuple, np.ndarray] = {}
+
+
+def latest_door_times(latest: BimResult, doors: Sequence[str]) -> np.ndarray:
+    """`models.door_times()` of the latest result, computed once per result."""
+    key = (latest.model_id, latest.requested_ts)
+    with _door_times_lock:
+        if key not in _door_times:
+            _door_times.clear()
+            _door_times[key] = models.door_times(ntx.node_link_graph(latest.graph), doors)
+        return _door_times[key]
+
+
+def latest_doors(model: models.BimModel, graph: JsonValue) -> tuple[str, ...]:
+    """The doors of a model that are nodes of a result graph, in the order of the model."""
+    graph_nodes = {node['id'] for node in graph['nodes']}
+    return tuple(door for door in model.doors.door_name if door in graph_nodes)
+
+
+def point_times(db: Database, points: Sequence[DistancePoint]) -> DistanceResult:
+    """Compute the runner times from each point to each door in the latest result.
+
+    The distance fields only give the times to the doors that can be reached without passing
+    through another door, e.g. the doors of the room containing a point. The times to the other
+    doors are found by continuing from those along the paths of the latest result's graph.
+    """
+    latest = db['results-latest'].find_one()
+    if latest is None or latest.get('model_id') is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, 'Not found')
+    latest = BimResult.model_validate(latest)
+
+    try:
+        model = bim_db.load_model(db, latest.model_id)
+    except KeyError as exc:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, 'Not found') from exc
+
+    doors = latest_doors(model, latest.graph)
+    columns = {door: k for k, door in enumerate(doors)}
+
+    floors = np.array([p.floor for p in points], dtype=object)
+    xs = np.array([p.x for p in points], dtype=np.float64)
+    ys = np.array([p.y for p in points], dtype=np.float64)
+
+    direct = np.full((len(points), len(doors)), np.nan)
+    for floor in set(floors):
+        if floor not in model.elevations:
+            raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, f'Unknown floor: {floor}')
+        try:
+            fields = distance_fields.get(latest.model_id, floor, doors)
+        except DistanceFieldsTooLarge as exc:
+            raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, str(exc)) from exc
+        if not fields.doors:
+            continue
+        rows = np.flatnonzero(floors == floor)
+        cols = [columns[door] for door in fields.doors]
+        direct[np.ix_(rows, cols)] = \
+            fields.distances(xs[rows], ys[rows]) / models.DEFAULT_RUNNER_SPEED
+
+    # times[i, k] = min over doors d of direct[i, d] + door_times[d, k]; fmin ignores the NaN of
+    # points outside the floor grid
+    between_doors = latest_door_times(latest, doors)
+    times = np.full_like(direct, np.nan)
+    for d in np.flatnonzero(np.isfinite(direct).any(axis=0)):
+        np.fmin(times, direct[:, d, np.newaxis] + between_doors[d], out=times)
+
+    return DistanceResult(
+        doors=list(doors),
+        times=np.where(np.isfinite(times), times, None).tolist()
+    )
+
+
+@api.get('/distance',
+         summary='Get runner times from a position to each door',
+         description="""\
+Get the runner times from a position on a floor to each door in the latest result: the shortest
+path on the floor grid to a door that can be reached without passing through another door (e.g.
+a door of the room containing the position), followed by the shortest path in the latest
+result's graph from that door. Doors on other floors are reached through the extra paths
+(lifts, stairs) of the latest result.""")
+def distance(floor: Annotated[str, Query(title='Floor', description='Name of the floor.')],
+             x: Annotated[float, Query(description='x-coordinate in metres.')],
+             y: Annotated[float, Query(description='y-coordinate in metres.')],
+             db: Annotated[Database, Depends(get_db)]) -> DistanceResult:
+    """Runner times from one position"""
+    return point_times(db, [DistancePoint(floor=floor, x=x, y=y)])
+
+
+@api.post('/distance',
+          summary='Get runner times from a batch of positions to each door',
+          description="""\
+Get the runner times from each of a batch of positions to each door in the latest result.
+The distance field of each door is computed once per BIM model and cached, so that large
+batches are answered by array lookup.""")
+def distance_batch(request: DistanceRequest,
+                   db: Annotated[Database, Depends(get_db)]) -> DistanceResult:
+    """Runner times from a batch of positions"""
+    return point_times(db, request.points)
+
+
 class AcceptedResponseModel(BaseModel):
     """Schema for an accepted / (root) POST request"""
     detail: Literal['Accepted'] = 'Accepted'
@@ -222,12 +680,25 @@ def update(file: UploadFile,
            form_data: Annotated[str, Form()]):
     """Compute new runner times based on the POST request."""
     ts = now()
-    params = json.loads(form_data)
+    try:
+        params = BimRequestParams.model_validate_json(form_data)
+    except ValidationError as exc:  # Including malformed JSON
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            exc.errors(include_url=False, include_context=False)) from exc
+
+    # Since `ifcopenshell.open()` expects a filename rather than a file object, copy the
+    # upload to the spool directory; the background task deletes it once parsed.
+    path, cache_key = spool_upload(file)
 
     # Create a new request in the Mongo database and set the status to "Running"
-    result = db['results'].insert_one(
-        BimResult(status='Running', requested_ts=ts).model_dump())
-    background_tasks.add_task(handle_bim_request, file, params, result.inserted_id, ts)
+    try:
+        result = db['results'].insert_one(
+            BimResult(status='Running', requested_ts=ts, progress=0.0,
+                      cache_key=cache_key).model_dump())
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    background_tasks.add_task(handle_bim_request, path, cache_key, params, result.inserted_id)
 
     return AcceptedResponseModel(id=str(result.inserted_id))
 
@@ -267,6 +738,149 @@ def query(id: Annotated[str,
     return validated_result
 
 
+SSE_RESPONSES = {
+    200: {
+        'description': 'A stream of server-sent events.',
+        'content': {'text/event-stream': {}}
+    }
+}
+
+
+async def job_events(_id: ObjectId):
+    """Server-sent events for a job: a "status" event whenever the job document changes,
+    then a final "result" event once the job has finished."""
+    client = bim_db.connect()
+    collection = client[bim_db.DB_NAME]['results']
+    try:
+        with notifier.subscribe(str(_id)) as subscription:
+            last = None
+            while True:
+                doc = await run_in_threadpool(collection.find_one, {'_id': _id})
+                if doc is None:
+                    return
+                result = BimResult.model_validate(doc)
+                if result.status != 'Running':
+                    yield sse('result', result)
+                    return
+                if result != last:
+                    yield sse('status', result)
+                    last = result
+                if not await subscription.wait():
+                    yield KEEP_ALIVE
+    finally:
+        client.close()
+
+
+async def latest_events():
+    """Server-sent events for the latest result: a "latest" event with the current result
+    (if any), then another each time it is replaced."""
+    client = bim_db.connect()
+    collection = client[bim_db.DB_NAME]['results-latest']
+    try:
+        with notifier.subscribe(LATEST) as subscription:
+            last = None
+            while True:
+                doc = await run_in_threadpool(collection.find_one)
+                if doc is not None:
+                    result = BimResult.model_validate(doc)
+                    if result != last:
+                        yield sse('latest', result)
+                        last = result
+                if not await subscription.wait():
+                    yield KEEP_ALIVE
+    finally:
+        client.close()
+
+
+@api.get('/stream',
+         summary='Stream job status',
+         description="""\
+Stream the status of a previously submitted request to update the BIM data, as
+[server-sent events](https://html.spec.whatwg.org/multipage/server-sent-events.html).
+
+A "status" event containing the job object is sent immediately and whenever its status or
+progress changes. When the job finishes, a final "result" event is sent and the stream is
+closed (if the job has already finished, only the "result" event is sent). Use this instead of
+repeatedly polling `/query`.""",
+         response_class=StreamingResponse,
+         responses=SSE_RESPONSES)
+def stream(id: Annotated[str,
+                         Query(
+                             title='Job ID',
+                             description='MongoDB object ID as a 24-hex-digit string.',
+                             example='665ed486d196679480be839a')],
+           db: Annotated[Database, Depends(get_db)]):
+    """Stream request status"""
+
+    _id = ObjectId(id)
+    if db['results'].find_one({'_id': _id}, projection={'_id': True}) is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, 'Not found')
+
+    return StreamingResponse(job_events(_id), media_type='text/event-stream')
+
+
+@api.get('/latest/stream',
+         summary='Stream the latest runner times result',
+         description="""\
+Stream the latest runner times result as
+[server-sent events](https://html.spec.whatwg.org/multipage/server-sent-events.html).
+
+A "latest" event is sent immediately if a result exists, and again each time a newer
+result replaces it. The stream stays open until the client disconnects.""",
+         response_class=StreamingResponse,
+         responses=SSE_RESPONSES)
+def stream_latest():
+    """Stream the latest result"""
+    return StreamingResponse(latest_events(), media_type='text/event-stream')
+
+
+@api.get('/metrics',
+         summary='Get performance metrics',
+         description="""\
+Get the number of running jobs, the stage timings of recently finished jobs, latency
+percentiles of recent `/latest` and `/query` requests, and grid cache statistics.
+
+To poll for updates without re-reading the job history, pass the `cursor` of the previous
+response as `since`.""")
+def get_metrics(db: Annotated[Database, Depends(get_db)],
+                since: Annotated[float, Query(
+                    description='Only return jobs finished after this UNIX timestamp.'
+                )] = 0.0,
+                limit: Annotated[int, Query(
+                    description='Maximum number of jobs to return.', ge=1, le=1000
+                )] = 200) -> metrics.Metrics:
+    """Performance metrics"""
+    docs = list(
+        db['results']
+        .find({'finished_ts': {'$gt': since}},
+              projection={'status': True, 'requested_ts': True, 'finished_ts': True,
+                          'timings': True})
+        .sort('finished_ts', 1)
+        .limit(limit)
+    )
+    jobs = [
+        metrics.JobTimings(id=str(doc.pop('_id')), **{'timings': {}} | doc)
+        for doc in docs
+    ]
+
+    # Lookups by the API process, which runs the jobs unless BIM_DISTRIBUTED is set, and by the
+    # workers
+    cache = default_cache()
+    totals = [(cache.hits, cache.misses)] if cache is not None else []
+    worker_stats = tasks.worker_cache_stats(db)
+    if worker_stats is not None:
+        totals.append(worker_stats)
+
+    return metrics.Metrics(
+        cursor=jobs[-1].finished_ts if jobs else since,
+        queue_depth=db['results'].count_documents({'status': 'Running'}),
+        jobs=jobs,
+        latency=metrics.latency.summary(),
+        cache=metrics.CacheStats(hits=sum(t[0] for t in totals),
+                                 misses=sum(t[1] for t in totals)) if totals else None
+    )
+
+
 @api.get("/docs", include_in_schema=False)
 async def custom_swagger_ui_html():
     IS_DOCKER = check_docker
@@ -0,0 +1,139 @@
+"""On-disk cache of floor rasters and distance fields.
+
+Arrays are stored as `.npy` files in a cache directory shared by all BIM processes, and loaded
+with `np.load(mmap_mode='r')`, so that repeated lookups neither recompute the arrays nor copy
+them into each process's memory. When the total size of the cache exceeds its budget, the least
+recently used files are deleted.
+
+The cache is enabled by setting the `BIM_CACHE_DIR` environment variable; the size budget in
+bytes can be set with `BIM_CACHE_MAX_BYTES`.
+"""
+
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import Callable, Optional
+
+import numpy as np
+
+DEFAULT_MAX_BYTES = 1 << 30
+"""Default size budget of the cache (1 GiB)."""
+
+
+class GridCache:
+    """LRU cache of numpy arrays, stored as memory-mapped `.npy` files."""
+
+    def __init__(self, directory: os.PathLike, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        """Number of lookups served from the cache by this instance."""
+
+        self.misses = 0
+        """Number of lookups by this instance that required a computation."""
+
+    def _path(self, key: str) -> Path:
+        # Keys may contain characters that are not valid in file names
+        return self.directory / (hashlib.sha256(key.encode()).hexdigest() + '.npy')
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Load an array from the cache as a read-only memory map, or None if not cached."""
+        path = self._path(key)
+        try:
+            array = np.load(path, mmap_mode='r')
+            os.utime(path)  # Mark as recently used
+        except (FileNotFoundError, ValueError):  # Missing, or evicted while loading
+            return None
+        return array
+
+    def put(self, key: str, array: np.ndarray) -> np.ndarray:
+        """Store an array in the cache, evicting old entries if necessary.
+
+        Returns:
+            The stored array, as a read-only memory map.
+        """
+        path = self._path(key)
+
+        # Write to a temporary file first so that readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        # Never evict the new entry itself, even if it is larger than the whole budget
+        self.evict(keep=key)
+        try:
+            return np.load(path, mmap_mode='r')
+        except FileNotFoundError:  # Evicted by another process
+            return array
+
+    def get_or_compute(self, key: str, compute: Callable[[], np.ndarray]) -> np.ndarray:
+        """Load an array from the cache, or compute and store it."""
+        array = self.get(key)
+        if array is not None:
+            self.hits += 1
+            return array
+        self.misses += 1
+        return self.put(key, compute())
+
+    def size(self) -> int:
+        """Total size of the cached files, in bytes."""
+        return sum(p.stat().st_size for p in self.directory.glob('*.npy'))
+
+    def evict(self, keep: Optional[str] = None):
+        """Delete the least recently used files until the cache fits in its size budget,
+        except for the entry with key `keep`."""
+        kept = None if keep is None else self._path(keep)
+        entries = []
+        for p in self.directory.glob('*.npy'):
+            if p == kept:
+                continue
+            try:
+                stat = p.stat()
+            except FileNotFoundError:  # Evicted by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, p))
+
+        total = sum(size for _, size, _ in entries)
+        if kept is not None:
+            try:
+                total += kept.stat().st_size
+            except FileNotFoundError:
+                pass
+        for _, size, p in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            # Processes that have already mapped the file keep their view of it
+            p.unlink(missing_ok=True)
+            total -= size
+
+
+def cached(cache: Optional[GridCache],
+           key: str,
+           compute: Callable[[], np.ndarray]) -> np.ndarray:
+    """`cache.get_or_compute(key, compute)`, or just `compute()` if `cache` is None."""
+    if cache is None:
+        return compute()
+    return cache.get_or_compute(key, compute)
+
+
+_default_cache: Optional[GridCache] = None
+
+
+def default_cache() -> Optional[GridCache]:
+    """The cache configured by the `BIM_CACHE_DIR` and `BIM_CACHE_MAX_BYTES` environment
+    variables, or None if `BIM_CACHE_DIR` is not set."""
+    global _default_cache  # pylint: disable=global-statement
+    if _default_cache is None and os.environ.get('BIM_CACHE_DIR'):
+        _default_cache = GridCache(
+            os.environ['BIM_CACHE_DIR'],
+            int(os.environ.get('BIM_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+        )
+    return _default_cache
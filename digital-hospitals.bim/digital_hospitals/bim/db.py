@@ -0,0 +1,227 @@
+"""MongoDB connection and storage helpers for the BIM service."""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from pymongo import MongoClient
+from pymongo.collection import Collection
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError
+
+from digital_hospitals.bim import models
+from digital_hospitals.bim.lazy import lazy_import
+from digital_hospitals.common import (MONGODB_PORT, MONGODB_TIMEOUT, MONGODB_URL, MONGODB_USER,
+                                      mongodb_password)
+
+ntx = lazy_import('networkx')
+
+logger = logging.getLogger(__name__)
+
+DB_NAME = os.environ.get('BIM_DB_NAME', 'bim')
+"""Name of the MongoDB database used by the BIM service. Can be overridden with the
+`BIM_DB_NAME` environment variable, e.g. to run `digital_hospitals.bim.loadtest` without touching
+the service's data."""
+
+MODELS = 'models'
+"""Collection containing the BIM models of submitted jobs."""
+
+RESULTS = 'results'
+"""Collection containing one `BimResult` document per submitted job."""
+
+RESULTS_LATEST = 'results-latest'
+"""Collection containing the most recently requested successful result."""
+
+FLOOR_GRAPHS = 'floor-graphs'
+"""Collection containing the logical graph of each floor computed so far, keyed by
+`models.floor_digest()`, for reuse by later jobs."""
+
+LATEST_ID = 'latest'
+"""`_id` of the single document in `RESULTS_LATEST`."""
+
+RESULT_RETENTION_SECONDS = int(os.environ.get('BIM_RESULT_RETENTION_SECONDS', 30 * 24 * 3600))
+"""Time after which finished jobs are deleted from `RESULTS` by MongoDB (30 days by default).
+The latest result is kept regardless."""
+
+MODEL_RETENTION_SECONDS = int(os.environ.get('BIM_MODEL_RETENTION_SECONDS', 30 * 24 * 3600))
+"""Time after which models and floor graphs that no job has used are deleted by
+`expire_unused()` (30 days by default). The model of the latest result is kept regardless."""
+
+_TOUCH_INTERVAL_SECONDS = 3600
+"""Minimum time between two updates of the `last_used` date of a model held in memory."""
+
+
+def connect() -> MongoClient:
+    """Open a new connection to the MongoDB server.
+
+    The caller is responsible for closing the returned client. Code running outside of a
+    request (background tasks, streaming responses, workers) should use this instead of the
+    `get_db` dependency, whose connection is closed when the request handler returns.
+    """
+    return MongoClient(MONGODB_URL, MONGODB_PORT, username=MONGODB_USER,
+                       password=mongodb_password(), timeoutMS=MONGODB_TIMEOUT)
+
+
+def ensure_indexes(db: Database):
+    """Create the indexes of the results, models and floor graphs collections, and move a latest
+    result stored by an earlier version of the service (with a generated `_id`) to `LATEST_ID`.
+
+    The retention policy is a TTL index on `finished_at`, the completion time of a job as a
+    date (MongoDB only expires documents by date fields). Running jobs are never expired.
+
+    Each step is attempted even if an earlier one fails, and failures are logged.
+    """
+    results = db[RESULTS]
+    steps = [
+        lambda: results.create_index('requested_ts'),
+        lambda: results.create_index('finished_ts'),
+        lambda: results.create_index('status'),
+        lambda: results.create_index('cache_key'),
+        lambda: ensure_ttl_index(results, 'finished_at', RESULT_RETENTION_SECONDS),
+        lambda: db[MODELS].create_index('last_used'),
+        lambda: db[FLOOR_GRAPHS].create_index('last_used'),
+        lambda: _migrate_latest(db),
+    ]
+    for step in steps:
+        try:
+            step()
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception('Could not prepare the %s database', db.name)
+
+
+def ensure_ttl_index(collection: Collection, field: str, expire_after_seconds: int):
+    """Create a TTL index on a date field, or change the expiry time of an existing one with
+    `collMod` (`create_index` fails with IndexOptionsConflict if the expiry time differs)."""
+    for index in collection.list_indexes():
+        if dict(index['key']) == {field: 1}:
+            if index.get('expireAfterSeconds') != expire_after_seconds:
+                collection.database.command(
+                    'collMod', collection.name,
+                    index={'keyPattern': {field: 1}, 'expireAfterSeconds': expire_after_seconds}
+                )
+            return
+    collection.create_index(field, expireAfterSeconds=expire_after_seconds)
+
+
+def _migrate_latest(db: Database):
+    for doc in db[RESULTS_LATEST].find({'_id': {'$ne': LATEST_ID}}):
+        doc_id = doc.pop('_id')
+        update_latest(db, doc)
+        db[RESULTS_LATEST].delete_one({'_id': doc_id})
+
+
+def update_latest(db: Database, result: dict) -> bool:
+    """Replace the latest result with `result`, unless the stored one was requested later.
+
+    This is a single conditional write, so it is safe when several jobs finish at once.
+
+    Returns:
+        True if the latest result was replaced.
+    """
+    query = {'_id': LATEST_ID, 'requested_ts': {'$lt': result['requested_ts']}}
+    try:
+        update = db[RESULTS_LATEST].replace_one(query, result, upsert=True)
+    except DuplicateKeyError:
+        # The filter did not match, so the upsert tried to insert a second document with the
+        # same `_id`: either the stored result is newer, or another job inserted the first
+        # latest result after our filter was evaluated, in which case ours may still be newer
+        update = db[RESULTS_LATEST].replace_one(query, result)
+    return update.matched_count > 0 or update.upserted_id is not None
+
+
+def expire_unused(db: Database, retention: float = MODEL_RETENTION_SECONDS):
+    """Delete the models and floor graphs that no job has used in the last `retention` seconds,
+    except the model of the latest result, which the `/distance` endpoints use."""
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=retention)
+    latest = db[RESULTS_LATEST].find_one({'_id': LATEST_ID}, projection={'model_id': True})
+    keep = [] if latest is None or latest.get('model_id') is None else [latest['model_id']]
+    db[MODELS].delete_many({'last_used': {'$lt': cutoff}, '_id': {'$nin': keep}})
+    db[FLOOR_GRAPHS].delete_many({'last_used': {'$lt': cutoff}})
+
+
+def store_model(db: Database, model_id: str, model: models.BimModel) -> models.BimModel:
+    """Store a BIM model in the `models` collection, in the binary format given by
+    `BimModel.to_npz()`.
+
+    Returns:
+        The model as it will be loaded by `load_model()`, i.e. with float32 coordinates. Use this
+        instead of `model` so that results do not depend on whether the model was just stored
+        or loaded from the database.
+    """
+    data = model.to_npz()
+    db[MODELS].replace_one({'_id': model_id},
+                           {'format': 'npz', 'data': data, 'last_used': datetime.now(timezone.utc)},
+                           upsert=True)
+    return models.BimModel.from_npz(data)
+
+
+_MODEL_CACHE: OrderedDict[str, tuple[models.BimModel, float]] = OrderedDict()
+"""The most recently used models, and when their `last_used` date was last updated."""
+_MODEL_CACHE_SIZE = 4
+_MODEL_CACHE_LOCK = threading.Lock()
+
+
+def load_model(db: Database, model_id: str) -> models.BimModel:
+    """Load a BIM model from the `models` collection, caching the most recently used ones, and
+    update its `last_used` date (at most once per hour for cached models).
+
+    Raises:
+        KeyError: If the model does not exist.
+    """
+    with _MODEL_CACHE_LOCK:
+        cached = _MODEL_CACHE.get(model_id)
+        if cached is not None:
+            _MODEL_CACHE.move_to_end(model_id)
+            if time.monotonic() - cached[1] < _TOUCH_INTERVAL_SECONDS:
+                return cached[0]
+            _MODEL_CACHE[model_id] = cached[0], time.monotonic()
+
+    touch = {'$set': {'last_used': datetime.now(timezone.utc)}}
+    if cached is not None:
+        db[MODELS].update_one({'_id': model_id}, touch)
+        return cached[0]
+
+    doc = db[MODELS].find_one_and_update({'_id': model_id}, touch)
+    if doc is None:
+        raise KeyError(f'Model not found: {model_id}')
+    if doc.get('format') == 'npz':
+        model = models.BimModel.from_npz(doc['data'])
+    else:  # JSON form, see `BimData`
+        model = models.BimData.model_validate(doc['data']).to_obj()
+
+    with _MODEL_CACHE_LOCK:
+        _MODEL_CACHE[model_id] = model, time.monotonic()
+        if len(_MODEL_CACHE) > _MODEL_CACHE_SIZE:
+            _MODEL_CACHE.popitem(last=False)
+    return model
+
+
+def load_floor_graphs(db: Database, floor_keys: dict[str, str]) -> dict[str, ntx.Graph]:
+    """Load the stored logical graphs of some levels.
+
+    Args:
+        floor_keys: The `models.floor_digest()` of each level, by level name.
+
+    Returns:
+        The logical graph of each level whose digest has a stored graph, by level name.
+    """
+    query = {'_id': {'$in': list(floor_keys.values())}}
+    docs = db[FLOOR_GRAPHS].find(query)
+    graphs = {doc['_id']: ntx.node_link_graph(doc['graph']) for doc in docs}
+    if graphs:
+        db[FLOOR_GRAPHS].update_many(query, {'$set': {'last_used': datetime.now(timezone.utc)}})
+    return {level: graphs[key] for level, key in floor_keys.items() if key in graphs}
+
+
+def store_floor_graph(db: Database, floor_key: str, graph: ntx.Graph):
+    """Store the logical graph of a level under its `models.floor_digest()`."""
+    db[FLOOR_GRAPHS].replace_one(
+        {'_id': floor_key},
+        {'graph': ntx.node_link_data(graph), 'last_used': datetime.now(timezone.utc)},
+        upsert=True
+    )
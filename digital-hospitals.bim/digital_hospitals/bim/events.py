@@ -0,0 +1,102 @@
+"""In-process notification of job status changes, for server-sent event (SSE) streams.
+
+Background tasks run in a worker thread and call `Notifier.publish()` whenever they write a job
+document to MongoDB. Streaming endpoints run on the event loop and hold a `Subscription` for the
+job (or for the latest result); a publish wakes the subscription, which then re-reads the
+document from MongoDB and pushes it to the client.
+"""
+
+import asyncio
+import threading
+from collections import defaultdict
+from typing import Optional
+
+from pydantic import BaseModel
+
+LATEST = 'latest'
+"""Notification key used when the latest result changes."""
+
+HEARTBEAT_SECONDS = 15.0
+"""Maximum time between two messages on an event stream. If nothing was published in this time,
+the stream re-reads the document (to catch updates made by other processes) and sends a
+keep-alive comment."""
+
+
+class Subscription:
+    """A subscription to the notifications for a single key. Use via `Notifier.subscribe()`."""
+
+    def __init__(self, notifier: 'Notifier', key: str):
+        self._notifier = notifier
+        self._key = key
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+
+    def _wake(self):
+        # Called from the publishing thread
+        self._loop.call_soon_threadsafe(self._event.set)
+
+    async def wait(self, timeout: Optional[float] = HEARTBEAT_SECONDS) -> bool:
+        """Wait for a notification.
+
+        Notifications published since the previous call are not lost: they cause this method
+        to return immediately.
+
+        Returns:
+            True if a notification was received, False on timeout.
+        """
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except TimeoutError:
+            return False
+        self._event.clear()
+        return True
+
+    def __enter__(self) -> 'Subscription':
+        self._notifier._add(self._key, self)
+        return self
+
+    def __exit__(self, *_):
+        self._notifier._remove(self._key, self)
+
+
+class Notifier:
+    """Thread-safe publish/subscribe hub keyed by job ID."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions: dict[str, set[Subscription]] = defaultdict(set)
+
+    def subscribe(self, key: str) -> Subscription:
+        """Create a subscription for `key`. Must be called from a running event loop and
+        used as a context manager."""
+        return Subscription(self, key)
+
+    def publish(self, key: str):
+        """Wake all subscriptions for `key`. Safe to call from any thread."""
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(key, ()))
+        for sub in subscriptions:
+            sub._wake()
+
+    def _add(self, key: str, sub: Subscription):
+        with self._lock:
+            self._subscriptions[key].add(sub)
+
+    def _remove(self, key: str, sub: Subscription):
+        with self._lock:
+            self._subscriptions[key].discard(sub)
+            if not self._subscriptions[key]:
+                del self._subscriptions[key]
+
+
+notifier = Notifier()
+"""Notifier shared by the background tasks and streaming endpoints of this process."""
+
+
+def sse(event: str, data: BaseModel) -> str:
+    """Format a Pydantic object as a server-sent event message."""
+    return f"event: {event}\ndata: {data.model_dump_json()}\n\n"
+
+
+KEEP_ALIVE = ': keep-alive\n\n'
+"""SSE comment line, ignored by clients, used to keep idle connections open."""
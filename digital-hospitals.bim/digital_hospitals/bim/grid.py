@@ -0,0 +1,252 @@
+"""Raster pathfinding on a floor grid.
+
+A floor is divided into square cells of side `grid_size`, using the same grid as
+`ShapelyModel.shortest_path`: cell `(i, j)` has its lower-left corner at
+`(x_min + i*grid_size, y_min + j*grid_size)`. A cell is passable unless it intersects a wall;
+cells intersecting the source or destination door are always passable. Runners move between
+neighbouring cells in the eight ordinal directions, and may only move diagonally if both cells
+sharing an edge with the two endpoints are passable.
+
+Instead of searching the grid separately for each pair of doors, we compute a distance field
+for each source door (the Dijkstra distance from the door to every cell of the floor), from which
+the distance to any destination door or point is a lookup.
+"""
+
+from __future__ import annotations
+
+import heapq
+import math
+from dataclasses import dataclass
+from functools import cached_property
+
+import numpy as np
+
+from digital_hospitals.bim.lazy import lazy_import
+
+shp = lazy_import('shapely')
+
+SQRT2 = 2**0.5
+
+
+@dataclass
+class FloorGrid:
+    """Grid of square cells covering the bounding box of a floor."""
+    x_min: float
+    y_min: float
+    grid_size: float
+    n_x: int
+    n_y: int
+
+    i0: int = 0
+    j0: int = 0
+    """If this grid is a window of a larger grid (see `window()`), the index of its first cell
+    in the larger grid. Cell `(i, j)` of the window is cell `(i0 + i, j0 + j)` of the larger
+    grid, and has the same coordinates."""
+
+    @staticmethod
+    def from_bounds(x_min: float, x_max: float, y_min: float, y_max: float,
+                    grid_size: float) -> 'FloorGrid':
+        """Construct the grid covering a bounding box, as in `ShapelyModel.shortest_path`."""
+        return FloorGrid(
+            x_min=x_min,
+            y_min=y_min,
+            grid_size=grid_size,
+            n_x=len(np.arange(x_min, x_max, grid_size)),
+            n_y=len(np.arange(y_min, y_max, grid_size))
+        )
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        """Shape of the arrays representing the grid."""
+        return self.n_x, self.n_y
+
+    def window(self, i_start: int, i_stop: int, j_start: int, j_stop: int) -> 'FloorGrid':
+        """The cells `[i_start, i_stop) x [j_start, j_stop)` of this grid, clipped to its
+        bounds, as a grid of their own."""
+        i_start, j_start = max(i_start, 0), max(j_start, 0)
+        return FloorGrid(
+            x_min=self.x_min,
+            y_min=self.y_min,
+            grid_size=self.grid_size,
+            n_x=max(min(i_stop, self.n_x) - i_start, 0),
+            n_y=max(min(j_stop, self.n_y) - j_start, 0),
+            i0=self.i0 + i_start,
+            j0=self.j0 + j_start
+        )
+
+    def window_around(self, bounds: tuple[float, float, float, float],
+                      margin: int = 2) -> 'FloorGrid':
+        """The window containing every cell intersecting a bounding box `(x_min, y_min, x_max,
+        y_max)`, and `margin` more cells on each side."""
+        x0, y0, x1, y1 = bounds
+        g = self.grid_size
+        i_start = math.floor((x0 - self.x_min) / g) - self.i0 - margin
+        i_stop = math.floor((x1 - self.x_min) / g) - self.i0 + margin + 1
+        j_start = math.floor((y0 - self.y_min) / g) - self.j0 - margin
+        j_stop = math.floor((y1 - self.y_min) / g) - self.j0 + margin + 1
+        return self.window(i_start, i_stop, j_start, j_stop)
+
+    @cached_property
+    def _cell_tree(self) -> shp.STRtree:
+        # Cells in row-major order, i.e. cell (i, j) has index i*n_y + j. Coordinates are
+        # computed from the indices in the full grid, so that the cells of a window are
+        # exactly the same boxes.
+        i, j = np.divmod(np.arange(self.n_x * self.n_y), self.n_y)
+        x0 = self.x_min + (self.i0 + i) * self.grid_size
+        y0 = self.y_min + (self.j0 + j) * self.grid_size
+        return shp.STRtree(shp.box(x0, y0, x0 + self.grid_size, y0 + self.grid_size))
+
+    def rasterize(self, shapes) -> np.ndarray:
+        """Boolean array marking the cells intersecting any of `shapes`."""
+        mask = np.zeros(self.n_x * self.n_y, dtype=bool)
+        shapes = np.atleast_1d(np.asarray(shapes, dtype=object))
+        if len(shapes) > 0:
+            _, cells = self._cell_tree.query(shapes, predicate='intersects')
+            mask[cells] = True
+        return mask.reshape(self.shape)
+
+    def cell_of(self, x: float, y: float) -> tuple[int, int]:
+        """The cell containing a point. For a point on the boundary between cells, the cell
+        with the lowest `(i, j)` is returned, as in `ShapelyModel.shortest_path`.
+
+        Raises:
+            IndexError: If the point is outside the grid.
+        """
+        cells = self._cell_tree.query(shp.Point(x, y), predicate='intersects')
+        if len(cells) == 0:
+            raise IndexError(f'Point ({x}, {y}) is outside the grid')
+        return tuple(int(k) for k in np.divmod(cells.min(), self.n_y))
+
+    def cells_of(self, x: np.ndarray, y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Vectorized lookup of the cells containing an array of points. Points outside the grid
+        are mapped to index -1."""
+        i = np.floor((np.asarray(x) - self.x_min) / self.grid_size).astype(np.intp) - self.i0
+        j = np.floor((np.asarray(y) - self.y_min) / self.grid_size).astype(np.intp) - self.j0
+        outside = (i < 0) | (i >= self.n_x) | (j < 0) | (j >= self.n_y)
+        i[outside] = -1
+        j[outside] = -1
+        return i, j
+
+
+def _neighbours(k: int, n_x: int, n_y: int, passable: list[bool]):
+    """Passable neighbours of flat cell index `k`, with step costs in grid units."""
+    i, j = divmod(k, n_y)
+    west = i > 0 and passable[k - n_y]
+    east = i < n_x - 1 and passable[k + n_y]
+    south = j > 0 and passable[k - 1]
+    north = j < n_y - 1 and passable[k + 1]
+    if west:
+        yield k - n_y, 1.0
+    if east:
+        yield k + n_y, 1.0
+    if south:
+        yield k - 1, 1.0
+    if north:
+        yield k + 1, 1.0
+    if west and south and passable[k - n_y - 1]:
+        yield k - n_y - 1, SQRT2
+    if west and north and passable[k - n_y + 1]:
+        yield k - n_y + 1, SQRT2
+    if east and south and passable[k + n_y - 1]:
+        yield k + n_y - 1, SQRT2
+    if east and north and passable[k + n_y + 1]:
+        yield k + n_y + 1, SQRT2
+
+
+def distance_field(passable: np.ndarray, source: tuple[int, int]) -> np.ndarray:
+    """Dijkstra distance, in grid units, from a source cell to every cell of the grid.
+
+    Args:
+        passable: Boolean array of passable cells.
+        source: The source cell, which must be passable.
+
+    Returns:
+        Array of the same shape as `passable`; unreachable cells have distance `inf`.
+    """
+    initial = np.full(passable.shape, np.inf)
+    initial[source] = 0.0
+    return relax(passable, initial)
+
+
+def relax(passable: np.ndarray, initial: np.ndarray) -> np.ndarray:
+    """Dijkstra distance, in grid units, to every cell of the grid from a set of source cells,
+    each with an initial distance.
+
+    Args:
+        passable: Boolean array of passable cells.
+        initial: Array of the same shape as `passable`, giving the initial distance of each
+            source cell and `inf` elsewhere. Impassable source cells are ignored.
+
+    Returns:
+        Array of the same shape as `passable`; unreachable cells have distance `inf`.
+    """
+    n_x, n_y = passable.shape
+    ok = passable.ravel().tolist()
+    dist = np.where(passable, initial, np.inf).ravel().tolist()
+
+    heap = [(d, k) for k, d in enumerate(dist) if d < math.inf]
+    heapq.heapify(heap)
+    while heap:
+        d, k = heapq.heappop(heap)
+        if d > dist[k]:
+            continue
+        for n, w in _neighbours(k, n_x, n_y, ok):
+            if d + w < dist[n]:
+                dist[n] = d + w
+                heapq.heappush(heap, (d + w, n))
+
+    return np.array(dist).reshape(passable.shape)
+
+
+def door_distance(field: np.ndarray,
+                  passable: np.ndarray,
+                  door_mask: np.ndarray,
+                  target: tuple[int, int]) -> float:
+    """Distance, in grid units, from the source of `field` to a destination door.
+
+    The cells of the destination door are passable when searching for a path to it, but were
+    not when `field` was computed. The field is therefore extended into these cells with a
+    local search seeded from the neighbouring cells.
+
+    Args:
+        field: Distance field of the source door, computed on `passable`.
+        passable: Boolean array of cells passable when computing `field`.
+        door_mask: Boolean array of cells intersecting the destination door.
+        target: The cell containing the centroid of the destination door.
+
+    Returns:
+        The distance, or `inf` if the door cannot be reached.
+    """
+    n_x, n_y = passable.shape
+    t = target[0] * n_y + target[1]
+    extra = np.flatnonzero((door_mask & ~passable).ravel())
+    if len(extra) == 0:
+        return float(field.flat[t])
+
+    ok = (passable | door_mask).ravel().tolist()
+    flat = field.ravel()
+    extra = set(extra.tolist())
+    nodes = extra | {t}
+
+    # Seed the local search with the distances from cells outside the door
+    dist = {}
+    for k in nodes:
+        d = flat[k] if k not in extra else math.inf
+        for n, w in _neighbours(k, n_x, n_y, ok):
+            if n not in nodes:
+                d = min(d, flat[n] + w)
+        dist[k] = float(d)
+
+    heap = [(d, k) for k, d in dist.items() if d < math.inf]
+    heapq.heapify(heap)
+    while heap:
+        d, k = heapq.heappop(heap)
+        if d > dist[k]:
+            continue
+        if k == t:
+            return d
+        for n, w in _neighbours(k, n_x, n_y, ok):
+            if n in nodes and d + w < dist[n]:
+                dist[n] = d + w
+                heapq.heappush(heap, (d + w, n))
+    return dist[t]
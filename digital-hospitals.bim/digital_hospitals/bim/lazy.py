@@ -0,0 +1,57 @@
+"""Deferred imports of the heavy geometry and graph libraries.
+
+Importing ifcopenshell, shapely, pandas, networkx and natsort takes a large part of the startup
+time of a BIM process, but most processes (e.g. the API serving `/latest` and `/query`) rarely
+need them. Modules in this package therefore import them with `lazy_import()`, which only loads
+the library on first attribute access. Processes that will need the libraries anyway, such as
+workers, can call `warm_up()` before taking jobs so that the first job does not pay the cost.
+"""
+
+import importlib
+import threading
+from types import ModuleType
+
+HEAVY_MODULES = (
+    'ifcopenshell',
+    'ifcopenshell.geom',
+    'ifcopenshell.util.shape',
+    'natsort',
+    'networkx',
+    'pandas',
+    'shapely',
+)
+"""Modules loaded by `warm_up()`."""
+
+
+class LazyModule:
+    """Stand-in for a module that imports it on first attribute access."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> ModuleType:
+        with self._lock:
+            if self._module is None:
+                self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr: str):
+        # Only called for attributes not set in __init__
+        return getattr(self._load(), attr)
+
+    def __repr__(self) -> str:
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f'<lazy module {self._name!r} ({state})>'
+
+
+def lazy_import(name: str) -> LazyModule:
+    """Import a module (or submodule) on first use."""
+    return LazyModule(name)
+
+
+def warm_up():
+    """Import the heavy libraries now, e.g. in a worker process before it takes jobs."""
+    for name in HEAVY_MODULES:
+        importlib.import_module(name)
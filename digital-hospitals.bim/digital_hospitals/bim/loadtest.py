@@ -0,0 +1,440 @@
+"""Load test for the BIM API.
+
+Run with `python -m digital_hospitals.bim.loadtest`. This starts the `api` app with uvicorn, using
+a separate database on the local MongoDB server, and sends a mix of concurrent `POST /`, `/query`
+and `/latest` requests for a fixed duration. Submitted jobs use a synthetic BIM model stored in
+the `models` collection under the hash of the uploaded bytes, so that the service loads it
+instead of parsing an IFC file; pass `--ifc` to upload a real IFC file instead.
+
+The result of each run is written as one line of JSON, including the current git commit, so that
+runs can be appended to a file and compared across commits.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from digital_hospitals.bim import db as bim_db
+from digital_hospitals.bim import models
+from digital_hospitals.common import MONGODB_PORT, MONGODB_USER, mongodb_password
+
+ENDPOINTS = ('/', '/query', '/latest')
+"""Endpoints exercised by the load test, in the order of the `--mix` weights."""
+
+DEFAULT_MIX = (1, 10, 10)
+"""Default relative frequencies of requests to `ENDPOINTS`."""
+
+DB_NAME = 'bim-loadtest'
+"""Database used by the API during a load test. It is dropped afterwards."""
+
+REQUEST_TIMEOUT = 60.0
+"""Timeout of a single HTTP request, in seconds."""
+
+
+def synthetic_model(floors: int = 2, rooms: int = 10) -> models.BimModel:
+    """A BIM model with `floors` identical floors, each with a central corridor and `rooms`
+    rooms of 4m x 4m on either side, with one door from each room to the corridor."""
+    walls = []
+    doors = []
+    width = 4.0 * rooms
+    t = 0.2  # Wall thickness
+
+    def wall(floor, z, name, x0, x1, y0, y1):
+        walls.append(dict(wall_name=f'{floor}:{name}', floor=floor,
+                          x0=x0, x1=x1, y0=y0, y1=y1, z0=z))
+
+    for f in range(floors):
+        floor = f'Level {f}'
+        z = 4.0 * f
+
+        # Outer walls, corridor walls between y=4 and y=6
+        wall(floor, z, 'S', 0, width, 0, t)
+        wall(floor, z, 'N', 0, width, 10 - t, 10)
+        wall(floor, z, 'W', 0, t, 0, 10)
+        wall(floor, z, 'E', width - t, width, 0, 10)
+        wall(floor, z, 'CS', 0, width, 4 - t, 4)
+        wall(floor, z, 'CN', 0, width, 6, 6 + t)
+
+        for r in range(rooms):
+            x = 4.0 * r
+            if r > 0:
+                wall(floor, z, f'P{r}S', x - t / 2, x + t / 2, 0, 4)
+                wall(floor, z, f'P{r}N', x - t / 2, x + t / 2, 6, 10)
+            doors.append(dict(door_name=f'{floor}:S{r}', floor=floor,
+                              x0=x + 1.5, x1=x + 2.5, y0=4 - t, y1=4, z0=z))
+            doors.append(dict(door_name=f'{floor}:N{r}', floor=floor,
+                              x0=x + 1.5, x1=x + 2.5, y0=6, y1=6 + t, z0=z))
+
+    return models.BimModel(elevations={f'Level {f}': 4.0 * f for f in range(floors)},
+                           doors=pd.DataFrame(doors),
+                           walls=pd.DataFrame(walls))
+
+
+def request_params(model: models.BimModel) -> dict:
+    """Request parameters including all doors of `model`, with a lift between the first doors
+    of consecutive floors."""
+    first_doors = model.doors.groupby('floor', observed=True).door_name.first().tolist()
+    return {
+        'door_list': model.doors.door_name.tolist(),
+        'extra_paths': [
+            {'path': [a, b], 'duration_seconds': 30.0, 'required_assets': ['lift']}
+            for a, b in zip(first_doors, first_doors[1:])
+        ]
+    }
+
+
+def prepare_upload(db, model: models.BimModel) -> bytes:
+    """Store `model` so that the service uses it for jobs uploading the returned bytes,
+    instead of parsing them as an IFC file."""
+    # Submitted files are identified by their SHA-256 hash (see `BimResult.cache_key`)
+    data = f'BIM load test model {uuid.uuid4()}\n'.encode()
+    bim_db.store_model(db, hashlib.sha256(data).hexdigest(), model)
+    return data
+
+
+def multipart(fields: dict[str, str], files: dict[str, bytes]) -> tuple[bytes, str]:
+    """Encode a multipart/form-data request body.
+
+    Returns:
+        The body and the value of the Content-Type header.
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+                     .encode() + value.encode() + b'\r\n')
+    for name, data in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                     f'filename="{name}.ifc"\r\nContent-Type: application/octet-stream\r\n\r\n'
+                     .encode() + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def request(url: str, data: Optional[bytes] = None,
+            headers: Optional[dict] = None) -> tuple[int, bytes]:
+    """Send a GET request, or a POST request if `data` is given.
+
+    Returns:
+        The HTTP status code and the response body. Error statuses are returned, not raised.
+    """
+    req = urllib.request.Request(url, data=data, headers=headers or {})
+    try:
+        with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as exc:
+        return exc.code, exc.read()
+
+
+class LoadGenerator:
+    """Closed-loop clients sending a random mix of requests to the BIM API."""
+
+    def __init__(self, url: str, upload: bytes, params: dict,
+                 mix: Sequence[float] = DEFAULT_MIX, seed: int = 0):
+        self.url = url.rstrip('/')
+        self.upload = upload
+        self.params = json.dumps(params)
+        self.weights = mix
+        self.seed = seed
+
+        self._lock = threading.Lock()
+        self.job_ids: list[str] = []
+        self.latencies: dict[str, list[float]] = {e: [] for e in ENDPOINTS}
+        self.errors: dict[str, int] = {e: 0 for e in ENDPOINTS}
+
+    def submit(self) -> Optional[str]:
+        """Submit a job.
+
+        Returns:
+            The job ID, or None if the request failed.
+        """
+        body, content_type = multipart({'form_data': self.params}, {'file': self.upload})
+        status, response = request(f'{self.url}/', body, {'Content-Type': content_type})
+        return json.loads(response)['id'] if status == 202 else None
+
+    def send(self, endpoint: str, rng: random.Random) -> bool:
+        """Send one request to `endpoint`.
+
+        Returns:
+            True if the request succeeded.
+        """
+        if endpoint == '/':
+            job_id = self.submit()
+            if job_id is not None:
+                with self._lock:
+                    self.job_ids.append(job_id)
+            return job_id is not None
+
+        if endpoint == '/query':
+            with self._lock:
+                job_id = rng.choice(self.job_ids)
+            status, _ = request(f'{self.url}/query?id={job_id}')
+            return status == 200
+
+        # There is no latest result until the first job has finished
+        status, _ = request(f'{self.url}/latest')
+        return status in (200, 404)
+
+    def client(self, index: int, deadline: float):
+        """Send requests until `deadline` (a `time.perf_counter()` value)."""
+        rng = random.Random(self.seed * 1000 + index)
+        while (start := time.perf_counter()) < deadline:
+            endpoint = rng.choices(ENDPOINTS, self.weights)[0]
+            try:
+                ok = self.send(endpoint, rng)
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.latencies[endpoint].append(elapsed)
+                if not ok:
+                    self.errors[endpoint] += 1
+
+    def run(self, duration: float, concurrency: int):
+        """Run `concurrency` clients for `duration` seconds."""
+        # `/query` needs at least one job to ask about
+        job_id = self.submit()
+        if job_id is None:
+            raise RuntimeError('Could not submit a job')
+        self.job_ids.append(job_id)
+
+        deadline = time.perf_counter() + duration
+        clients = [threading.Thread(target=self.client, args=(i, deadline))
+                   for i in range(concurrency)]
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+
+    def job_statuses(self) -> dict[str, int]:
+        """Number of submitted jobs with each status."""
+        counts = {}
+        for job_id in self.job_ids:
+            status, response = request(f'{self.url}/query?id={job_id}')
+            key = json.loads(response)['status'] if status == 200 else 'Unknown'
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def drain(self, timeout: float, poll: float = 1.0) -> dict[str, int]:
+        """Wait up to `timeout` seconds for all submitted jobs to finish.
+
+        Returns:
+            The number of jobs with each status at the end of the wait.
+        """
+        deadline = time.perf_counter() + timeout
+        while (counts := self.job_statuses()).get('Running', 0) > 0 \
+                and time.perf_counter() < deadline:
+            time.sleep(poll)
+        return counts
+
+
+def percentiles(seconds: Sequence[float]) -> dict[str, Optional[float]]:
+    """The 50th, 95th and 99th percentiles of `seconds`, in milliseconds."""
+    if len(seconds) == 0:
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None}
+    return dict(zip(('p50_ms', 'p95_ms', 'p99_ms'),
+                    (np.percentile(seconds, [50, 95, 99]) * 1000).tolist()))
+
+
+def peak_rss(pid: int) -> Optional[int]:
+    """Peak resident set size of a process in bytes, or None if unknown (e.g. not on Linux)."""
+    try:
+        with open(f'/proc/{pid}/status', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def git_commit() -> Optional[str]:
+    """The current git commit of this package, or None if unknown."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def free_port() -> int:
+    """An unused local TCP port."""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url: str, timeout: float = 30.0):
+    """Wait for an HTTP server to accept requests."""
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            request(url)
+            return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+@contextmanager
+def local_mongod(executable: str = 'mongod') -> Iterator[None]:
+    """Run a throwaway MongoDB server on `MONGODB_PORT`, with the root user expected by
+    `digital_hospitals.bim.db.connect()`."""
+    from pymongo import MongoClient
+
+    dbpath = tempfile.mkdtemp(prefix='bim-loadtest-mongod-')
+    proc = subprocess.Popen([executable, '--dbpath', dbpath, '--port', str(MONGODB_PORT),
+                             '--bind_ip', '127.0.0.1'], stdout=subprocess.DEVNULL)
+    try:
+        client = MongoClient('localhost', MONGODB_PORT, serverSelectionTimeoutMS=30000)
+        try:
+            client.admin.command('createUser', MONGODB_USER, pwd=mongodb_password(),
+                                 roles=['root'])
+        finally:
+            client.close()
+        yield
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(dbpath, ignore_errors=True)
+
+
+@contextmanager
+def api_server(port: int, env: dict[str, str]) -> Iterator[subprocess.Popen]:
+    """Run the BIM API with uvicorn on a local port."""
+    proc = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'digital_hospitals.bim.app:api',
+                             '--host', '127.0.0.1', '--port', str(port)],
+                            env=os.environ | env)
+    try:
+        wait_for(f'http://127.0.0.1:{port}/docs')
+        yield proc
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def run(duration: float = 30.0,
+        concurrency: int = 8,
+        mix: Sequence[float] = DEFAULT_MIX,
+        floors: int = 2,
+        rooms: int = 10,
+        ifc: Optional[Path] = None,
+        drain: float = 60.0,
+        seed: int = 0) -> dict:
+    """Start the API, run the load test and return the results."""
+    client = bim_db.connect()
+    db = client[DB_NAME]
+    try:
+        if ifc is None:
+            model = synthetic_model(floors, rooms)
+            upload = prepare_upload(db, model)
+        else:
+            model = models.BimModel.from_ifc(str(ifc))
+            upload = ifc.read_bytes()
+        params = request_params(model)
+
+        port = free_port()
+        # Jobs are computed by the API process, not by workers that may not be running
+        with api_server(port, {'BIM_DB_NAME': DB_NAME, 'BIM_DISTRIBUTED': '0'}) as server:
+            load = LoadGenerator(f'http://127.0.0.1:{port}', upload, params, mix, seed)
+            started = datetime.now(timezone.utc)
+            load.run(duration, concurrency)
+            jobs = load.drain(drain)
+            _, response = request(f'{load.url}/metrics?since={started.timestamp()}&limit=1000')
+            job_seconds = [j['finished_ts'] - j['requested_ts']
+                           for j in json.loads(response)['jobs']]
+            server_rss = peak_rss(server.pid)
+    finally:
+        client.drop_database(DB_NAME)
+        client.close()
+
+    return {
+        'commit': git_commit(),
+        'started': started.isoformat(),
+        'config': {
+            'duration_s': duration, 'concurrency': concurrency, 'mix': list(mix),
+            'model': str(ifc) if ifc is not None else f'synthetic {floors}x{rooms}',
+            'doors': len(params['door_list']), 'seed': seed
+        },
+        'requests': {
+            endpoint: {
+                'count': len(load.latencies[endpoint]),
+                'errors': load.errors[endpoint],
+                'error_rate': load.errors[endpoint] / max(len(load.latencies[endpoint]), 1),
+                'throughput_rps': len(load.latencies[endpoint]) / duration,
+                **percentiles(load.latencies[endpoint])
+            }
+            for endpoint in ENDPOINTS
+        },
+        'jobs': {'submitted': len(load.job_ids), 'statuses': jobs, **percentiles(job_seconds)},
+        'server_peak_rss_bytes': server_rss
+    }
+
+
+def main():
+    """Command-line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-d', '--duration', type=float, default=30.0,
+                        help='Duration of the load test in seconds (default: 30).')
+    parser.add_argument('-c', '--concurrency', type=int, default=8,
+                        help='Number of concurrent clients (default: 8).')
+    parser.add_argument('--mix', default=':'.join(map(str, DEFAULT_MIX)),
+                        help='Relative frequencies of POST /, /query and /latest requests '
+                        '(default: %(default)s).')
+    parser.add_argument('--floors', type=int, default=2,
+                        help='Number of floors of the synthetic model (default: 2).')
+    parser.add_argument('--rooms', type=int, default=10,
+                        help='Number of rooms on each side of the corridor of each floor of the '
+                        'synthetic model (default: 10).')
+    parser.add_argument('--ifc', type=Path,
+                        help='Upload this IFC file instead of using a synthetic model.')
+    parser.add_argument('--drain', type=float, default=60.0,
+                        help='Maximum time to wait for submitted jobs to finish after the load '
+                        'test, in seconds (default: 60).')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0).')
+    parser.add_argument('--start-mongod', metavar='EXECUTABLE', nargs='?', const='mongod',
+                        help='Start a throwaway MongoDB server instead of using the one '
+                        'already running.')
+    parser.add_argument('-o', '--output', type=Path,
+                        help='Append the results to this file instead of printing them.')
+    args = parser.parse_args()
+
+    mix = [float(w) for w in args.mix.split(':')]
+    if len(mix) != len(ENDPOINTS):
+        parser.error(f'--mix needs {len(ENDPOINTS)} weights')
+
+    with local_mongod(args.start_mongod) if args.start_mongod else nullcontext():
+        results = run(args.duration, args.concurrency, mix, args.floors, args.rooms, args.ifc,
+                      args.drain, args.seed)
+
+    line = json.dumps(results)
+    if args.output is None:
+        print(line)
+    else:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Instrumentation for the BIM service, reported by the `/metrics` endpoint."""
+
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Optional, Sequence
+
+import numpy as np
+from pydantic import BaseModel
+
+TRACKED_PATHS = ('/latest', '/query')
+"""Endpoints whose latencies are recorded."""
+
+LATENCY_WINDOW = 1000
+"""Number of recent requests per endpoint used to compute latency percentiles."""
+
+
+class LatencySummary(BaseModel):
+    """Latency percentiles of recent requests to an endpoint, in milliseconds."""
+    count: int
+    p50: Optional[float] = None
+    p95: Optional[float] = None
+    p99: Optional[float] = None
+
+
+class JobTimings(BaseModel):
+    """Duration of each stage of a finished job, in seconds."""
+    id: str
+    status: str
+    requested_ts: float
+    finished_ts: float
+    timings: dict[str, float]
+
+
+class CacheStats(BaseModel):
+    """Lookups in the grid cache of the API process since it started, and in those of all
+    workers that have run a task."""
+    hits: int
+    misses: int
+
+
+class Metrics(BaseModel):
+    """A snapshot of the BIM service's metrics."""
+
+    cursor: float
+    """Pass this as `since` in the next request to only receive newly finished jobs."""
+
+    queue_depth: int
+    """Number of jobs with status "Running"."""
+
+    jobs: Sequence[JobTimings]
+    """Jobs finished after `since`, oldest first."""
+
+    latency: dict[str, LatencySummary]
+
+    cache: Optional[CacheStats] = None
+    """Grid cache statistics, or null if the grid cache is disabled in the API process and no
+    worker has reported any."""
+
+
+class LatencyRecorder:
+    """Thread-safe record of the latencies of the most recent requests to each endpoint."""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._lock = threading.Lock()
+        self._samples: dict[str, deque[float]] = defaultdict(lambda: deque(maxlen=window))
+
+    def record(self, path: str, seconds: float):
+        """Record the latency of a request."""
+        with self._lock:
+            self._samples[path].append(seconds)
+
+    def summary(self) -> dict[str, LatencySummary]:
+        """Latency percentiles for each tracked endpoint."""
+        with self._lock:
+            samples = {path: np.array(self._samples[path]) for path in TRACKED_PATHS}
+        return {
+            path: LatencySummary(
+                count=len(s),
+                **({} if len(s) == 0 else dict(zip(
+                    ('p50', 'p95', 'p99'), (np.percentile(s, [50, 95, 99]) * 1000).tolist()
+                )))
+            )
+            for path, s in samples.items()
+        }
+
+
+latency = LatencyRecorder()
+"""Latency recorder for the current process."""
+
+
+@contextmanager
+def timed(timings: dict[str, float], stage: str):
+    """Record the duration of a block of code in `timings[stage]`, in seconds."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = time.perf_counter() - start
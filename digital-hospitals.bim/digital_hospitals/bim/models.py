@@ -10,24 +10,41 @@ runners can move in the eight ordinal directions. Runner times between floors ar
 defined based on the mode of movement, e.g. stairs or lift.
 """
 
+from __future__ import annotations
+
+import functools
+import hashlib
+import io
+import math
 from dataclasses import dataclass
 from functools import reduce
-from itertools import islice
 from os import PathLike
-from typing import Literal, Sequence
+from typing import Callable, Iterable, Literal, Optional, Sequence
 
-import ifcopenshell as ifc
-import natsort
-import networkx as ntx
 import numpy as np
-import pandas as pd
 import pydantic as pyd
-import shapely as shp
-from ifcopenshell import geom as ifc_geom
-from ifcopenshell.util import shape as ifc_shape
 
-settings = ifc_geom.settings()
-settings.set(settings.USE_WORLD_COORDS, True)  # Find global coordinates
+from digital_hospitals.bim import grid as bim_grid
+from digital_hospitals.bim import tiles as bim_tiles
+from digital_hospitals.bim.cache import GridCache, cached
+from digital_hospitals.bim.lazy import lazy_import
+
+# Heavy libraries are only loaded when first used, see `digital_hospitals.bim.lazy`
+ifc = lazy_import('ifcopenshell')
+ifc_geom = lazy_import('ifcopenshell.geom')
+ifc_shape = lazy_import('ifcopenshell.util.shape')
+natsort = lazy_import('natsort')
+ntx = lazy_import('networkx')
+pd = lazy_import('pandas')
+shp = lazy_import('shapely')
+
+
+@functools.cache
+def ifc_settings():
+    """Geometry settings for reading IFC files."""
+    settings = ifc_geom.settings()
+    settings.set(settings.USE_WORLD_COORDS, True)  # Find global coordinates
+    return settings
 
 DEFAULT_GRID_SIZE = 0.5
 """Default grid size in meters for pathfinding algorithm."""
@@ -35,6 +52,9 @@ DEFAULT_GRID_SIZE = 0.5
 DEFAULT_RUNNER_SPEED = 1.2
 """Default runner speed in m/s."""
 
+COORD_COLUMNS = ['x0', 'x1', 'y0', 'y1', 'z0']
+"""Coordinate columns of the door and wall dataframes of a BimModel."""
+
 
 class _BimDataDoors(pyd.BaseModel):
     door_name: Sequence[str]
@@ -82,6 +102,33 @@ class BimData(pyd.BaseModel):
         )
 
 
+def _encode_strings(values: Iterable[Optional[str]]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Encode strings as concatenated UTF-8 bytes, and the offset of each string.
+
+    Returns:
+        The bytes, the offsets, and a boolean mask of the missing values (e.g. None or NaN for IFC
+        objects without a name), which are encoded as empty strings.
+    """
+    values = list(values)
+    missing = np.array([pd.isna(v) for v in values], dtype=bool)
+    encoded = [b'' if m else str(v).encode() for v, m in zip(values, missing.tolist())]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets, missing
+
+
+def _decode_strings(data: np.ndarray,
+                    offsets: np.ndarray,
+                    missing: Optional[np.ndarray] = None) -> list[Optional[str]]:
+    """Inverse of `_encode_strings()`, with None for the missing values if `missing` is given."""
+    buffer = data.tobytes()
+    strings = [buffer[a:b].decode() for a, b in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+    if missing is not None:
+        for k in np.flatnonzero(missing).tolist():
+            strings[k] = None
+    return strings
+
+
 @dataclass
 class BimModel:
     """Representation of the histopathology lab's BIM data."""
@@ -95,6 +142,58 @@ class BimModel:
     walls: pd.DataFrame
     """Dataframe of wall coordinate data."""
 
+    def to_npz(self) -> bytes:
+        """Serialise a BimModel in a compact binary columnar format.
+
+        Each dataframe column is stored as an array in an (uncompressed) `.npz` archive:
+        coordinates as float32, floor names dictionary-encoded as indexes into a single list of
+        floors, and door and wall names as concatenated UTF-8 bytes with offsets and a mask of
+        missing names. Floors without an elevation are stored with a NaN elevation. This is much
+        smaller and faster to read than the JSON form given by `BimData`.
+        """
+        floors = sorted(set(self.elevations) | set(self.doors.floor) | set(self.walls.floor))
+        arrays = {'elevations': np.array([self.elevations.get(f, np.nan) for f in floors])}
+        arrays['floors'], arrays['floors_offsets'], _ = _encode_strings(floors)
+
+        for table, name_col in (('doors', 'door_name'), ('walls', 'wall_name')):
+            df: pd.DataFrame = getattr(self, table)
+            arrays[f'{table}_names'], arrays[f'{table}_names_offsets'], \
+                arrays[f'{table}_names_missing'] = _encode_strings(df[name_col])
+            arrays[f'{table}_floor'] = \
+                pd.Categorical(df.floor, categories=floors).codes.astype(np.int32)
+            for col in COORD_COLUMNS:
+                arrays[f'{table}_{col}'] = df[col].to_numpy(dtype=np.float32)
+
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        return buffer.getvalue()
+
+    @staticmethod
+    def from_npz(data: bytes) -> 'BimModel':
+        """Construct a BimModel from the output of `to_npz()`. The dataframe columns wrap the
+        decoded arrays without copying them."""
+        with np.load(io.BytesIO(data)) as npz:
+            floors = _decode_strings(npz['floors'], npz['floors_offsets'])
+            elevations = {
+                f: float(e) for f, e in zip(floors, npz['elevations']) if not np.isnan(e)
+            }
+
+            frames = {}
+            for table, name_col in (('doors', 'door_name'), ('walls', 'wall_name')):
+                columns = {
+                    # Models stored before missing names were recorded have no mask
+                    name_col: _decode_strings(npz[f'{table}_names'],
+                                              npz[f'{table}_names_offsets'],
+                                              npz.get(f'{table}_names_missing')),
+                    'floor': pd.Categorical.from_codes(npz[f'{table}_floor'],
+                                                       categories=floors)
+                }
+                for col in COORD_COLUMNS:
+                    columns[col] = npz[f'{table}_{col}']
+                frames[table] = pd.DataFrame(columns, copy=False)
+
+        return BimModel(elevations=elevations, doors=frames['doors'], walls=frames['walls'])
+
     @staticmethod
     def from_ifc(path: PathLike) -> 'BimModel':
         """Parse an Industry Foundation Model file
@@ -119,7 +218,7 @@ class BimModel:
         # Get the bounding box of an IFC object; for our IFC file,
         # all walls and doors are aligned to the xyz axes.
         def get_coords(obj: ifc.entity_instance) -> dict[str, float]:
-            shape = ifc_geom.create_shape(settings, obj)
+            shape = ifc_geom.create_shape(ifc_settings(), obj)
             grouped_verts = ifc_shape.get_vertices(shape.geometry)
             return {
                 'x0': min(map(lambda xyz: xyz[0], grouped_verts)),
@@ -189,9 +288,19 @@ class ShapelyModel:
 
     BoxType = Literal['ok_door', 'wall', 'empty']
 
-    def __init__(self, bim_model: BimModel, level: str, include_doors: Sequence[str]):
+    digest: str
+    """Hash of the wall geometry of the floor, used as a cache key for floor rasters."""
+
+    def __init__(self, bim_model: BimModel, level: str, include_doors: Sequence[str],
+                 cache: Optional[GridCache] = None, tile_size: Optional[int] = None):
         """Construct a ShapelyModel from a level of a BimModel, including only doors
-        of interest."""
+        of interest.
+
+        If `cache` is given, floor rasters and distance fields are stored in and loaded from it.
+        If `tile_size` is given, `door_distances` splits the floor grid into tiles of
+        `tile_size` cells per side instead of holding all of it in memory
+        (see `digital_hospitals.bim.tiles`).
+        """
         doors = bim_model.doors.loc[bim_model.doors.door_name.isin(include_doors)]
 
         wall_shapes = [
@@ -223,6 +332,12 @@ class ShapelyModel:
         self.wall_shapes = wall_shapes
         self.door_shapes = door_shapes
         self.bounds = ShapelyModel._Bounds(x_min=x_min, x_max=x_max, y_min=y_min, y_max=y_max)
+        self.digest = geometry_digest(bim_model.walls.loc[bim_model.walls.floor == level])
+        self._cache = cache
+        self._grids: dict[float, bim_grid.FloorGrid] = {}
+        self._door_masks: dict[tuple[str, float], np.ndarray] = {}
+        self._tile_size = tile_size
+        self._tiled_floors: dict[float, bim_tiles.TiledFloor] = {}
 
     def is_valid_box(self,
                      box: shp.Polygon,
@@ -340,14 +455,97 @@ class ShapelyModel:
 
         return path_length, path_graph
 
+    def floor_grid(self, grid_size=DEFAULT_GRID_SIZE) -> bim_grid.FloorGrid:
+        """The pathfinding grid for this floor."""
+        if grid_size not in self._grids:
+            self._grids[grid_size] = bim_grid.FloorGrid.from_bounds(
+                self.bounds.x_min, self.bounds.x_max, self.bounds.y_min, self.bounds.y_max,
+                grid_size
+            )
+        return self._grids[grid_size]
+
+    def tiled_floor(self, grid_size=DEFAULT_GRID_SIZE) -> bim_tiles.TiledFloor:
+        """The tiled pathfinding grid for this floor. Requires `tile_size` to have been given."""
+        if grid_size not in self._tiled_floors:
+            self._tiled_floors[grid_size] = bim_tiles.TiledFloor(
+                self.floor_grid(grid_size), self.wall_shapes, self._tile_size, self.digest,
+                cache=self._cache
+            )
+        return self._tiled_floors[grid_size]
+
+    def wall_mask(self, grid_size=DEFAULT_GRID_SIZE) -> np.ndarray:
+        """Boolean raster of the grid cells intersecting a wall."""
+        return cached(
+            self._cache,
+            f'walls/{self.digest}/{grid_size}',
+            lambda: self.floor_grid(grid_size).rasterize(self.wall_shapes)
+        )
+
+    def door_mask(self, door: str, grid_size=DEFAULT_GRID_SIZE) -> np.ndarray:
+        """Boolean raster of the grid cells intersecting a door."""
+        if (door, grid_size) not in self._door_masks:
+            self._door_masks[door, grid_size] = \
+                self.floor_grid(grid_size).rasterize(self.door_shapes[door])
+        return self._door_masks[door, grid_size]
+
+    def door_cell(self, door: str, grid_size=DEFAULT_GRID_SIZE) -> tuple[int, int]:
+        """The grid cell containing the centroid of a door."""
+        centroid = self.door_shapes[door].centroid
+        return self.floor_grid(grid_size).cell_of(centroid.x, centroid.y)
+
+    def distance_field(self, door: str, grid_size=DEFAULT_GRID_SIZE) -> np.ndarray:
+        """Shortest path distance in metres from a door to each cell of the floor grid,
+        passing through neither walls nor other doors. Unreachable cells have distance `inf`.
+        """
+        def compute():
+            passable = ~self.wall_mask(grid_size) | self.door_mask(door, grid_size)
+            field = bim_grid.distance_field(passable, self.door_cell(door, grid_size))
+            return (field * grid_size).astype(np.float32)
+
+        return cached(
+            self._cache, f'field/{self.digest}/{grid_size}/{self.door_shapes[door].bounds}', compute
+        )
+
+    def door_distances(self,
+                       from_door: str,
+                       to_doors: Sequence[str],
+                       grid_size=DEFAULT_GRID_SIZE) -> dict[str, float]:
+        """Find the shortest path lengths from a door to other doors in the model, in metres.
+        Doors that cannot be reached have distance `inf`.
+
+        Equivalent to calling `shortest_path` for each pair of doors, but only searches the grid
+        once.
+        """
+        if self._tile_size is not None:
+            distances = self.tiled_floor(grid_size).door_distances(
+                self.door_shapes[from_door], [self.door_shapes[d] for d in to_doors]
+            )
+            return {d: dist * grid_size for d, dist in zip(to_doors, distances)}
+
+        field = self.distance_field(from_door, grid_size) / grid_size
+        passable = ~self.wall_mask(grid_size) | self.door_mask(from_door, grid_size)
+        return {
+            to_door: bim_grid.door_distance(
+                field, passable, self.door_mask(to_door, grid_size),
+                self.door_cell(to_door, grid_size)
+            ) * grid_size
+            for to_door in to_doors
+        }
+
     def logical_graph(self,
-                      speed: float = DEFAULT_RUNNER_SPEED) -> ntx.Graph:
+                      speed: float = DEFAULT_RUNNER_SPEED,
+                      on_pair: Optional[Callable[[], None]] = None,
+                      sources: Optional[Sequence[str]] = None) -> ntx.Graph:
         """Construct a logical graph representation of the floor model,
         with nodes representing doors and edge weights representing travel
         times in seconds.
 
         Args:
             speed: Runner speed in m/s.
+            on_pair: Called after each pair of doors has been processed, e.g. to report progress.
+            sources: If given, only compute the edges from these doors to the doors following
+                them in `door_shapes`. The graphs for a partition of the doors into batches of
+                sources can be composed to obtain the full graph.
 
         Returns:
             The logical graph for the given floor model.
@@ -356,15 +554,92 @@ class ShapelyModel:
         keys = list(self.door_shapes.keys())
         graph.add_nodes_from(keys)
         for i, k1 in enumerate(keys):
-            for _, k2 in islice(enumerate(keys), i+1, None):
-                try:
-                    path_len, _ = self.shortest_path(k1, k2)
-                    graph.add_edge(k1, k2, weight=path_len/speed)  # weight = runner_time
-                except ntx.NetworkXNoPath:
-                    continue
+            if sources is not None and k1 not in sources:
+                continue
+            path_lens = self.door_distances(k1, keys[i+1:])
+            for k2 in keys[i+1:]:
+                if path_lens[k2] < math.inf:
+                    graph.add_edge(k1, k2, weight=path_lens[k2]/speed)  # weight = runner_time
+                if on_pair is not None:
+                    on_pair()
         return graph
 
 
+@dataclass
+class DistanceFields:
+    """The distance fields of all doors on a floor, for computing the travel distance from
+    arbitrary points to each door by array lookup."""
+
+    grid: bim_grid.FloorGrid
+    doors: list[str]
+    fields: list[np.ndarray]
+    """Distance field of each door in `doors`, in metres."""
+
+    @staticmethod
+    def from_model(s_model: ShapelyModel, grid_size=DEFAULT_GRID_SIZE) -> 'DistanceFields':
+        """Compute (or load from the model's cache) the distance field of each door
+        in a ShapelyModel."""
+        doors = list(s_model.door_shapes.keys())
+        return DistanceFields(
+            grid=s_model.floor_grid(grid_size),
+            doors=doors,
+            fields=[s_model.distance_field(door, grid_size) for door in doors]
+        )
+
+    def distances(self, x: Sequence[float], y: Sequence[float]) -> np.ndarray:
+        """Shortest path distances from a batch of points to each door, in metres.
+
+        Returns:
+            Array of shape `(len(x), len(doors))`. Distances from points in a wall or
+            unable to reach a door are `inf`; points outside the floor grid give `nan`.
+        """
+        i, j = self.grid.cells_of(np.asarray(x, dtype=np.float64),
+                                  np.asarray(y, dtype=np.float64))
+        inside = i >= 0
+        result = np.full((len(i), len(self.doors)), np.nan)
+        for k, field in enumerate(self.fields):
+            result[inside, k] = field[i[inside], j[inside]]
+        return result
+
+
+def door_times(graph: ntx.Graph, doors: Sequence[str]) -> np.ndarray:
+    """Shortest path runner times between each pair of doors in a logical graph.
+
+    Returns:
+        Array of shape `(len(doors), len(doors))`, with `inf` for doors that cannot reach each
+        other.
+    """
+    nodelist = list(doors) + [node for node in graph.nodes if node not in set(doors)]
+    return ntx.floyd_warshall_numpy(graph, nodelist=nodelist)[:len(doors), :len(doors)]
+
+
+def geometry_digest(df: pd.DataFrame) -> str:
+    """Hash of the coordinates of a set of walls or doors, independent of row order."""
+    coords = df[['x0', 'x1', 'y0', 'y1']].to_numpy(dtype=np.float64)
+    coords = coords[np.lexsort(coords.T[::-1])]
+    return hashlib.sha256(coords.tobytes()).hexdigest()
+
+
+def floor_digest(model: BimModel,
+                 level: str,
+                 door_list: Sequence[str],
+                 runner_speed: float = DEFAULT_RUNNER_SPEED,
+                 grid_size: float = DEFAULT_GRID_SIZE) -> str:
+    """Hash of everything the logical graph of a level depends on: the level's walls, the
+    names and coordinates of its doors in `door_list`, the runner speed and the grid size.
+    Versions of a building model whose hashes match for a level have the same logical graph
+    for that level."""
+    walls = model.walls.loc[model.walls.floor == level]
+    doors = model.doors.loc[model.doors.door_name.isin(door_list) & (model.doors.floor == level)]
+    doors = doors.sort_values('door_name')
+    h = hashlib.sha256()
+    h.update(geometry_digest(walls).encode())
+    h.update('\0'.join(doors.door_name).encode())
+    h.update(doors[['x0', 'x1', 'y0', 'y1']].to_numpy(dtype=np.float64).tobytes())
+    h.update(np.array([runner_speed, grid_size], dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
 class Path(pyd.BaseModel):
     """Defines a direct path between two doors, with a travel duration."""
     path: tuple[str, str]
@@ -372,10 +647,27 @@ class Path(pyd.BaseModel):
     required_assets: Sequence[str]
 
 
+def included_levels(model: BimModel, door_list: Sequence[str]) -> list[str]:
+    """List the levels of a BimModel containing at least one of the doors in `door_list`."""
+    return list(model.doors.loc[model.doors.door_name.isin(door_list)].floor.unique())
+
+
+def included_doors(model: BimModel, level: str, door_list: Sequence[str]) -> list[str]:
+    """List the doors in `door_list` on a given level, in the same order as the keys of
+    `ShapelyModel.door_shapes`."""
+    doors = model.doors
+    return list(doors.loc[doors.door_name.isin(door_list) & (doors.floor == level)].door_name)
+
+
 def logical_graph(model: BimModel,
                   door_list: Sequence[str],
                   extra_paths: Sequence[Path],
-                  runner_speed: float = DEFAULT_RUNNER_SPEED) -> ntx.Graph:
+                  runner_speed: float = DEFAULT_RUNNER_SPEED,
+                  progress: Optional[Callable[[float], None]] = None,
+                  cache: Optional[GridCache] = None,
+                  tile_size: Optional[int] = None,
+                  floor_graphs: Optional[dict[str, ntx.Graph]] = None,
+                  on_floor: Optional[Callable[[str, ntx.Graph], None]] = None) -> ntx.Graph:
     """Construct a logical graph representation of the histopathology lab,
         with nodes representing doors and edge weights representing travel
         times in seconds.
@@ -385,20 +677,64 @@ def logical_graph(model: BimModel,
         door_list (Sequence[str]): List of doors to nclude in the logical graph, by name.
         runner_speed (float): Runner speed in m/s.
         extra_paths (Sequence[PathDefinition]): Paths connecting different floors of the lab.
+        progress (Callable[[float], None], optional): Called with the fraction of door pairs
+            processed so far, between 0 and 1.
+        cache (GridCache, optional): Cache for floor rasters and distance fields.
+        tile_size (int, optional): If given, find paths on tiles of this many cells per side
+            instead of on the whole floor grid, to bound memory use on large floors.
+        floor_graphs (dict[str, ntx.Graph], optional): Previously computed logical graphs of
+            some levels, by level name, which are used instead of recomputing them
+            (see `floor_digest`).
+        on_floor (Callable[[str, ntx.Graph], None], optional): Called with the name and logical
+            graph of each level computed, e.g. to store it for reuse.
 
     Returns:
         ntx.Graph: The logical graph for the lab.
     """
-    target_levels = list(model.doors.loc[model.doors.door_name.isin(door_list)].floor.unique())
-
-    logical_graphs = {}
+    floor_graphs = floor_graphs or {}
+    target_levels = [
+        level for level in included_levels(model, door_list) if level not in floor_graphs
+    ]
+
+    s_models = {
+        level: ShapelyModel(model, level=level, include_doors=door_list, cache=cache,
+                            tile_size=tile_size)
+        for level in target_levels
+    }
+
+    n_pairs = sum(len(m.door_shapes) * (len(m.door_shapes) - 1) // 2 for m in s_models.values())
+    n_done = 0
+
+    def on_pair():
+        nonlocal n_done
+        n_done += 1
+        progress(n_done / n_pairs)
+
+    logical_graphs = dict(floor_graphs)
     # Build the logical graph for each target level and compose them
-    for level in target_levels:
-        s_model = ShapelyModel(model, level=level, include_doors=door_list)
-        l_graph = s_model.logical_graph(runner_speed)
+    for level, s_model in s_models.items():
+        l_graph = s_model.logical_graph(runner_speed, on_pair if progress is not None else None)
         logical_graphs[level] = l_graph
+        if on_floor is not None:
+            on_floor(level, l_graph)
+
+    return compose_logical_graph(logical_graphs.values(), extra_paths)
+
 
-    full_logical_graph = ntx.compose_all(logical_graphs.values())
+def compose_logical_graph(graphs: Iterable[ntx.Graph],
+                          extra_paths: Sequence[Path]) -> ntx.Graph:
+    """Compose partial logical graphs, e.g. one per floor, into the logical graph of the
+    histopathology lab, and add the extra paths connecting different floors.
+
+    Args:
+        graphs (Iterable[ntx.Graph]): Partial logical graphs.
+        extra_paths (Sequence[PathDefinition]): Paths connecting different floors of the lab.
+
+    Returns:
+        ntx.Graph: The logical graph for the lab.
+    """
+    graphs = list(graphs)
+    full_logical_graph = ntx.compose_all(graphs) if graphs else ntx.Graph()
 
     # Add extra paths between levels
     for path in extra_paths:
@@ -0,0 +1,362 @@
+"""Distributed computation of logical graphs using a MongoDB-backed task queue.
+
+A job is split by `submit()` into one task per floor and batch of source doors (see the
+`sources` argument of `ShapelyModel.logical_graph`). Any number of workers (see
+`digital_hospitals.bim.worker`) can claim tasks from the `tasks` collection. A claimed task is
+leased to its worker for `LEASE_SECONDS`, and the worker renews the lease while it is running; if
+the worker dies, the lease expires and the task is claimed by another worker, up to
+`MAX_ATTEMPTS` times. The coordinator (the process that submitted the job) waits for all tasks
+with `wait()` and merges the partial graphs.
+"""
+
+from __future__ import annotations
+
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, Literal, Optional, Sequence
+
+import pymongo
+from bson import ObjectId
+from pydantic import BaseModel, Field, JsonValue
+from pymongo import ReturnDocument
+from pymongo.database import Database
+
+from digital_hospitals.bim import models
+from digital_hospitals.bim.cache import GridCache, default_cache
+from digital_hospitals.bim.db import RESULTS, ensure_ttl_index, load_model
+from digital_hospitals.bim.lazy import lazy_import
+from digital_hospitals.bim.tiles import default_tile_size
+
+ntx = lazy_import('networkx')
+
+TASKS = 'tasks'
+"""Collection containing the task queue."""
+
+WORKER_STATS = 'worker-stats'
+"""Collection containing the grid cache statistics of each worker, for the `/metrics` endpoint."""
+
+LEASE_SECONDS = 60.0
+"""Time after which a task claimed by an unresponsive worker may be claimed again."""
+
+MAX_ATTEMPTS = 3
+"""Maximum number of times a task is claimed before the job is failed."""
+
+DEFAULT_BATCH_SIZE = 4
+"""Default number of source doors per task."""
+
+POLL_SECONDS = 1.0
+"""Time between two checks of the task queue, for workers and coordinators."""
+
+JOB_TIMEOUT_SECONDS = float(os.environ.get('BIM_JOB_TIMEOUT_SECONDS', 3600))
+"""Time after which a coordinator stops waiting for the tasks of a job and fails it, e.g. if no
+worker is running. Can be set with the `BIM_JOB_TIMEOUT_SECONDS` environment variable."""
+
+
+class Task(BaseModel):
+    """A unit of work: the logical graph edges of one floor, from a batch of source doors."""
+    job_id: str
+    """ID of the job (BimResult document) this task belongs to."""
+
+    model_id: str
+    """ID of the BIM model in the `models` collection (see `digital_hospitals.bim.db`)."""
+
+    level: str
+    door_list: Sequence[str]
+    sources: Sequence[str]
+    runner_speed: float
+
+    status: Literal['Pending', 'Running', 'OK', 'Error'] = 'Pending'
+    attempts: int = 0
+    worker: Optional[str] = None
+    lease_expires: Optional[float] = None
+
+    graph: Optional[JsonValue] = None
+    """If `status` is "OK", the partial logical graph in node-link format."""
+
+    err_msg: Optional[str] = None
+    """If the last attempt failed, the error message."""
+
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    """When the task was published. Tasks are deleted by MongoDB `JOB_TIMEOUT_SECONDS` later,
+    since no coordinator waits for them any more."""
+
+
+def ensure_indexes(db: Database):
+    """Create the indexes used to claim and collect tasks."""
+    db[TASKS].create_index([('status', pymongo.ASCENDING), ('lease_expires', pymongo.ASCENDING)])
+    db[TASKS].create_index('job_id')
+    ensure_ttl_index(db[TASKS], 'created_at', int(JOB_TIMEOUT_SECONDS))
+
+
+def delete_orphaned(db: Database):
+    """Delete the tasks of jobs that are no longer running, e.g. those of a coordinator that
+    stopped while waiting for them, so that workers do not compute results nobody collects."""
+    job_ids = [ObjectId(job_id) for job_id in db[TASKS].distinct('job_id')
+               if ObjectId.is_valid(job_id)]
+    running = [str(doc['_id']) for doc in db[RESULTS].find(
+        {'_id': {'$in': job_ids}, 'status': 'Running'}, projection={'_id': True}
+    )]
+    db[TASKS].delete_many({'job_id': {'$nin': running}})
+
+
+def submit(db: Database,
+           job_id: str,
+           model_id: str,
+           model: models.BimModel,
+           door_list: Sequence[str],
+           runner_speed: float = models.DEFAULT_RUNNER_SPEED,
+           batch_size: int = DEFAULT_BATCH_SIZE,
+           levels: Optional[Sequence[str]] = None) -> int:
+    """Publish the tasks for a job. The model must have been stored with
+    `digital_hospitals.bim.db.store_model()` under `model_id`.
+
+    If `levels` is given, only publish the tasks for these levels.
+
+    Returns:
+        The number of tasks published.
+    """
+    tasks = []
+    for level in models.included_levels(model, door_list):
+        if levels is not None and level not in levels:
+            continue
+        doors = models.included_doors(model, level, door_list)
+        # The last door on each floor has no edges to compute as a source
+        for i in range(0, max(len(doors) - 1, 1), batch_size):
+            tasks.append(Task(job_id=job_id, model_id=model_id, level=level,
+                              door_list=door_list, sources=doors[i:i+batch_size],
+                              runner_speed=runner_speed))
+
+    if tasks:
+        db[TASKS].insert_many([t.model_dump() for t in tasks])
+    return len(tasks)
+
+
+def claim(db: Database, worker: str, lease: float = LEASE_SECONDS) -> Optional[dict]:
+    """Claim the oldest pending task, or a running task whose lease has expired.
+
+    Returns:
+        The claimed task document, or None if no task is available.
+    """
+    now = time.time()
+    return db[TASKS].find_one_and_update(
+        {
+            '$or': [
+                {'status': 'Pending'},
+                {'status': 'Running', 'lease_expires': {'$lt': now}}
+            ],
+            'attempts': {'$lt': MAX_ATTEMPTS}
+        },
+        {
+            '$set': {'status': 'Running', 'worker': worker, 'lease_expires': now + lease},
+            '$inc': {'attempts': 1}
+        },
+        sort=[('_id', pymongo.ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def renew(db: Database, task_id, worker: str, lease: float = LEASE_SECONDS) -> bool:
+    """Extend the lease of a running task.
+
+    Returns:
+        False if the task is no longer leased to `worker`.
+    """
+    result = db[TASKS].update_one({'_id': task_id, 'status': 'Running', 'worker': worker},
+                                  {'$set': {'lease_expires': time.time() + lease}})
+    return result.matched_count > 0
+
+
+def complete(db: Database, task_id, worker: str, graph: ntx.Graph):
+    """Store the result of a task."""
+    db[TASKS].update_one({'_id': task_id, 'status': 'Running', 'worker': worker},
+                         {'$set': {'status': 'OK', 'graph': ntx.node_link_data(graph),
+                                   'lease_expires': None}})
+
+
+def fail(db: Database, task_id, worker: str, err_msg: str):
+    """Release a task after an error, so that it can be retried if it has attempts left."""
+    db[TASKS].update_one({'_id': task_id, 'status': 'Running', 'worker': worker},
+                         [{'$set': {
+                             'status': {'$cond': [{'$lt': ['$attempts', MAX_ATTEMPTS]},
+                                                  'Pending', 'Error']},
+                             'err_msg': err_msg,
+                             'worker': None,
+                             'lease_expires': None
+                         }}])
+
+
+def run_task(db: Database, task: Task) -> ntx.Graph:
+    """Compute the partial logical graph for a task."""
+    model = load_model(db, task.model_id)
+    s_model = models.ShapelyModel(model, level=task.level, include_doors=task.door_list,
+                                  cache=default_cache(), tile_size=default_tile_size())
+    return s_model.logical_graph(task.runner_speed, sources=task.sources)
+
+
+def report_cache_stats(db: Database,
+                       worker: str,
+                       cache: GridCache,
+                       reported: tuple[int, int]) -> tuple[int, int]:
+    """Add the lookups in a worker's grid cache since its last report to its counters in the
+    `worker-stats` collection.
+
+    Args:
+        reported: The hits and misses of `cache` at the last report.
+
+    Returns:
+        The hits and misses of `cache` now, to pass as `reported` in the next report.
+    """
+    hits, misses = cache.hits, cache.misses
+    db[WORKER_STATS].update_one(
+        {'_id': worker},
+        {'$inc': {'hits': hits - reported[0], 'misses': misses - reported[1]},
+         '$set': {'updated_at': datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    return hits, misses
+
+
+def worker_cache_stats(db: Database) -> Optional[tuple[int, int]]:
+    """The total grid cache hits and misses reported by all workers, or None if no worker with
+    a grid cache has run a task."""
+    docs = list(db[WORKER_STATS].find(projection={'hits': True, 'misses': True}))
+    if not docs:
+        return None
+    return sum(doc['hits'] for doc in docs), sum(doc['misses'] for doc in docs)
+
+
+def worker_name() -> str:
+    """A name identifying the current worker process."""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def work(db: Database,
+         stop: threading.Event,
+         worker: Optional[str] = None,
+         lease: float = LEASE_SECONDS,
+         poll: float = POLL_SECONDS):
+    """Claim and run tasks until `stop` is set."""
+    worker = worker or worker_name()
+    ensure_indexes(db)
+    cache = default_cache()
+    reported = (0, 0)
+
+    while not stop.is_set():
+        doc = claim(db, worker, lease)
+        if doc is None:
+            stop.wait(poll)
+            continue
+
+        # Keep the lease alive while the task is running
+        done = threading.Event()
+
+        def heartbeat(task_id=doc['_id']):
+            while not done.wait(lease / 3):
+                if not renew(db, task_id, worker, lease):
+                    return
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        try:
+            try:
+                graph = run_task(db, Task.model_validate(doc))
+            finally:
+                # Reported before completing the task, so that the statistics include the
+                # lookups of a job once it has finished
+                if cache is not None:
+                    reported = report_cache_stats(db, worker, cache, reported)
+            complete(db, doc['_id'], worker, graph)
+        except Exception as exc:
+            fail(db, doc['_id'], worker, str(exc))
+        finally:
+            done.set()
+            heartbeat_thread.join()
+
+
+def wait(db: Database,
+         job_id: str,
+         progress: Optional[Callable[[float], None]] = None,
+         poll: float = POLL_SECONDS,
+         timeout: float = JOB_TIMEOUT_SECONDS) -> dict[str, ntx.Graph]:
+    """Wait for all tasks of a job to finish, then remove them from the queue.
+
+    Returns:
+        The logical graph of each level, merged from the partial graphs computed by the tasks.
+
+    Raises:
+        RuntimeError: If a task failed `MAX_ATTEMPTS` times.
+        TimeoutError: If the tasks did not finish within `timeout` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            # Tasks whose last lease expired after their final attempt will never be claimed
+            db[TASKS].update_many(
+                {'job_id': job_id, 'status': 'Running', 'attempts': {'$gte': MAX_ATTEMPTS},
+                 'lease_expires': {'$lt': time.time()}},
+                {'$set': {'status': 'Error', 'err_msg': 'Worker lease expired'}}
+            )
+
+            counts = {
+                doc['_id']: doc['count'] for doc in db[TASKS].aggregate([
+                    {'$match': {'job_id': job_id}},
+                    {'$group': {'_id': '$status', 'count': {'$sum': 1}}}
+                ])
+            }
+            n_total = sum(counts.values())
+
+            if counts.get('Error', 0) > 0:
+                failed = db[TASKS].find_one({'job_id': job_id, 'status': 'Error'})
+                raise RuntimeError(f"Task for level {failed['level']} failed: {failed['err_msg']}")
+
+            if progress is not None and n_total > 0:
+                progress(counts.get('OK', 0) / n_total)
+
+            if counts.get('OK', 0) == n_total:
+                partial_graphs = {}
+                for doc in db[TASKS].find({'job_id': job_id},
+                                          projection={'level': True, 'graph': True}):
+                    partial_graphs.setdefault(doc['level'], []).append(
+                        ntx.node_link_graph(doc['graph']))
+                return {level: ntx.compose_all(graphs)
+                        for level, graphs in partial_graphs.items()}
+
+            if time.monotonic() > deadline:
+                if db[TASKS].count_documents({'job_id': job_id, 'attempts': {'$gt': 0}}) == 0:
+                    raise TimeoutError(f'No worker claimed a task within {timeout:g}s; '
+                                       'is a bim-worker process running?')
+                raise TimeoutError(f"Only {counts.get('OK', 0)} of {n_total} tasks finished "
+                                   f'within {timeout:g}s')
+
+            time.sleep(poll)
+    finally:
+        db[TASKS].delete_many({'job_id': job_id})
+
+
+def logical_graph(db: Database,
+                  job_id: str,
+                  model_id: str,
+                  model: models.BimModel,
+                  door_list: Sequence[str],
+                  extra_paths: Sequence[models.Path],
+                  runner_speed: float = models.DEFAULT_RUNNER_SPEED,
+                  progress: Optional[Callable[[float], None]] = None,
+                  floor_graphs: Optional[dict[str, ntx.Graph]] = None,
+                  on_floor: Optional[Callable[[str, ntx.Graph], None]] = None) -> ntx.Graph:
+    """Distributed equivalent of `models.logical_graph`: publish the tasks for a job,
+    wait for the workers to compute them and merge the results."""
+    floor_graphs = floor_graphs or {}
+    levels = [
+        level for level in models.included_levels(model, door_list) if level not in floor_graphs
+    ]
+    logical_graphs = dict(floor_graphs)
+    if levels:
+        submit(db, job_id, model_id, model, door_list, runner_speed, levels=levels)
+        for level, graph in wait(db, job_id, progress).items():
+            logical_graphs[level] = graph
+            if on_floor is not None:
+                on_floor(level, graph)
+    return models.compose_logical_graph(logical_graphs.values(), extra_paths)
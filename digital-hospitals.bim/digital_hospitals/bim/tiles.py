@@ -0,0 +1,292 @@
+"""Tiled pathfinding for floors whose grid does not fit in memory.
+
+The floor grid (see `digital_hospitals.bim.grid`) is split into square tiles of `tile_size` cells
+per side. The passable cells on the edges of a tile that face another tile are its *portals*:
+a path from one tile to another always steps from a portal of the first tile to a portal of the
+second. For each tile, we compute the shortest path distances between its portals without
+leaving the tile; routes across the floor are then found with Dijkstra's algorithm on the graph
+of portals, in which the portals of each tile form a clique. Distances to individual cells are
+only computed for the tiles around the destination doors.
+
+At most `max_bytes` of tiles are held in memory, the least recently used tiles being dropped;
+with a grid cache, dropped tiles are loaded again from it instead of being recomputed. Since the
+cells of the source door are passable, the tiles it intersects are rebuilt for each source door.
+
+Distances are the same as those of `ShapelyModel.door_distances`, up to the rounding of the
+portal distances to float32.
+"""
+
+from __future__ import annotations
+
+import heapq
+import math
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Optional, Sequence
+
+import numpy as np
+
+from digital_hospitals.bim import grid as bim_grid
+from digital_hospitals.bim.cache import GridCache, cached
+from digital_hospitals.bim.lazy import lazy_import
+
+shp = lazy_import('shapely')
+
+DEFAULT_MAX_BYTES = 256 << 20
+"""Default memory budget for the tiles of a floor (256 MiB)."""
+
+_STEPS = [(-1, 0, 1.0), (1, 0, 1.0), (0, -1, 1.0), (0, 1, 1.0),
+          (-1, -1, bim_grid.SQRT2), (-1, 1, bim_grid.SQRT2),
+          (1, -1, bim_grid.SQRT2), (1, 1, bim_grid.SQRT2)]
+
+
+def default_tile_size() -> Optional[int]:
+    """The tile size in cells configured by the `BIM_TILE_SIZE` environment variable, or None if
+    it is not set, in which case distances are computed on the whole floor grid."""
+    value = os.environ.get('BIM_TILE_SIZE')
+    return int(value) if value else None
+
+
+@dataclass
+class Tile:
+    """A tile of a floor grid, and the distances between its portals."""
+    grid: bim_grid.FloorGrid
+    """The cells of the tile, as a window of the floor grid."""
+
+    passable: np.ndarray
+    """Boolean array of passable cells."""
+
+    portals: np.ndarray
+    """Flat indices of the portal cells in `passable`."""
+
+    rows: np.ndarray
+    """Index in `portals` of each cell, or -1 for cells that are not portals."""
+
+    distances: np.ndarray
+    """Distances between each pair of portals within the tile, in grid units."""
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the tile's arrays."""
+        return self.passable.nbytes + self.portals.nbytes + self.rows.nbytes + \
+            self.distances.nbytes
+
+
+class TiledFloor:
+    """Pathfinding on a floor grid, holding only some of its tiles in memory at once."""
+
+    def __init__(self,
+                 grid: bim_grid.FloorGrid,
+                 wall_shapes: Sequence[shp.Polygon],
+                 tile_size: int,
+                 digest: str,
+                 cache: Optional[GridCache] = None,
+                 max_bytes: Optional[int] = None):
+        """
+        Args:
+            grid: The floor grid.
+            wall_shapes: The walls of the floor.
+            tile_size: Number of cells per side of a tile.
+            digest: Hash of the wall geometry of the floor, used in cache keys
+                (see `ShapelyModel.digest`).
+            cache: If given, tile rasters and portal distances are stored in and loaded from it.
+            max_bytes: Memory budget for the tiles held in memory. Defaults to the
+                `BIM_TILE_MAX_BYTES` environment variable, or `DEFAULT_MAX_BYTES`.
+        """
+        self.grid = grid
+        self.tile_size = tile_size
+        self.digest = digest
+        self.max_bytes = max_bytes if max_bytes is not None else \
+            int(os.environ.get('BIM_TILE_MAX_BYTES', DEFAULT_MAX_BYTES))
+        self.n_tiles = (math.ceil(grid.n_x / tile_size), math.ceil(grid.n_y / tile_size))
+
+        self._walls = shp.STRtree(wall_shapes)
+        self._cache = cache
+        self._tiles: OrderedDict[tuple, Tile] = OrderedDict()
+        self._bytes = 0
+
+    def _key(self, kind: str, a: int, b: int) -> str:
+        return f'{kind}/{self.digest}/{self.grid.grid_size}/{self.tile_size}/{a},{b}'
+
+    def tile_grid(self, a: int, b: int) -> bim_grid.FloorGrid:
+        """The cells of tile `(a, b)`."""
+        t = self.tile_size
+        return self.grid.window(a * t, (a + 1) * t, b * t, (b + 1) * t)
+
+    def wall_mask(self, a: int, b: int) -> np.ndarray:
+        """Boolean raster of the cells of tile `(a, b)` intersecting a wall."""
+        def compute():
+            tile_grid = self.tile_grid(a, b)
+            g = tile_grid.grid_size
+            box = shp.box(tile_grid.x_min + tile_grid.i0 * g,
+                          tile_grid.y_min + tile_grid.j0 * g,
+                          tile_grid.x_min + (tile_grid.i0 + tile_grid.n_x) * g,
+                          tile_grid.y_min + (tile_grid.j0 + tile_grid.n_y) * g)
+            walls = self._walls.geometries.take(self._walls.query(box, predicate='intersects'))
+            return tile_grid.rasterize(walls)
+
+        return cached(self._cache, self._key('tile-walls', a, b), compute)
+
+    def tile(self, a: int, b: int, door: Optional[shp.Polygon] = None) -> Tile:
+        """Load or build tile `(a, b)`, with the cells of `door` passable if given."""
+        key = (a, b, None if door is None else door.bounds)
+        if key in self._tiles:
+            self._tiles.move_to_end(key)
+            return self._tiles[key]
+
+        tile_grid = self.tile_grid(a, b)
+        passable = ~self.wall_mask(a, b)
+        if door is not None:
+            passable |= tile_grid.rasterize(door)
+
+        # Portals are the passable cells on the edges facing other tiles
+        edges = np.zeros(passable.shape, dtype=bool)
+        edges[0, :] |= a > 0
+        edges[-1, :] |= a < self.n_tiles[0] - 1
+        edges[:, 0] |= b > 0
+        edges[:, -1] |= b < self.n_tiles[1] - 1
+        portals = np.flatnonzero(edges & passable)
+        rows = np.full(passable.size, -1, dtype=np.int32)
+        rows[portals] = np.arange(len(portals))
+
+        def portal_distances():
+            if len(portals) == 0:
+                return np.zeros((0, 0), dtype=np.float32)
+            return np.stack([
+                bim_grid.distance_field(passable, divmod(int(p), tile_grid.n_y)).ravel()[portals]
+                for p in portals
+            ]).astype(np.float32)
+
+        cache_key = self._key('tile', a, b) + ('' if door is None else f'/{door.bounds}')
+        tile = Tile(grid=tile_grid, passable=passable, portals=portals, rows=rows,
+                    distances=cached(self._cache, cache_key, portal_distances))
+
+        self._tiles[key] = tile
+        self._bytes += tile.nbytes
+        while self._bytes > self.max_bytes and len(self._tiles) > 1:
+            _, evicted = self._tiles.popitem(last=False)
+            self._bytes -= evicted.nbytes
+        return tile
+
+    def door_distances(self,
+                       from_door: shp.Polygon,
+                       to_doors: Sequence[shp.Polygon]) -> list[float]:
+        """Find the shortest path lengths from a door to other doors, in grid units, passing
+        through neither walls nor other doors. Doors that cannot be reached have distance `inf`.
+        """
+        t = self.tile_size
+
+        # Tiles intersecting the source door are rebuilt with its cells passable
+        window = self.grid.window_around(from_door.bounds)
+        cells = np.argwhere(window.rasterize(from_door)) + (window.i0, window.j0)
+        dirty = {(i // t, j // t) for i, j in cells.tolist()}
+
+        def get_tile(a: int, b: int) -> Tile:
+            return self.tile(a, b, from_door if (a, b) in dirty else None)
+
+        centroid = from_door.centroid
+        si, sj = window.cell_of(centroid.x, centroid.y)
+        source = (window.i0 + si, window.j0 + sj)
+        portal_dist = self._search(get_tile, source)
+
+        # Distances to the cells of the tiles around each destination door
+        fields = {}
+
+        def tile_field(a: int, b: int) -> np.ndarray:
+            if (a, b) not in fields:
+                tile = get_tile(a, b)
+                initial = np.full(tile.passable.shape, np.inf)
+                if (a, b) in portal_dist:
+                    initial.flat[tile.portals] = portal_dist[a, b]
+                if (a, b) == (source[0] // t, source[1] // t):
+                    initial[source[0] % t, source[1] % t] = 0.0
+                fields[a, b] = bim_grid.relax(tile.passable, initial)
+            return fields[a, b]
+
+        distances = []
+        for door in to_doors:
+            window = self.grid.window_around(door.bounds)
+            centroid = door.centroid
+            distances.append(bim_grid.door_distance(
+                self._assemble(window, tile_field, np.inf),
+                self._assemble(window, lambda a, b: get_tile(a, b).passable, False),
+                window.rasterize(door),
+                window.cell_of(centroid.x, centroid.y)
+            ))
+        return distances
+
+    def _search(self,
+                get_tile: Callable[[int, int], Tile],
+                source: tuple[int, int]) -> dict[tuple[int, int], np.ndarray]:
+        """Dijkstra's algorithm on the portal graph.
+
+        Returns:
+            The distance from `source` to each portal of each reached tile, in grid units.
+        """
+        t = self.tile_size
+        n_x, n_y = self.grid.shape
+
+        def passable(i: int, j: int) -> bool:
+            return bool(get_tile(i // t, j // t).passable[i % t, j % t])
+
+        a, b = source[0] // t, source[1] // t
+        tile = get_tile(a, b)
+        dist = {
+            (a, b): bim_grid.distance_field(tile.passable, (source[0] % t, source[1] % t))
+            .ravel()[tile.portals]
+        }
+        heap = [(d, a, b, r) for r, d in enumerate(dist[a, b].tolist()) if d < math.inf]
+        heapq.heapify(heap)
+
+        while heap:
+            d, a, b, r = heapq.heappop(heap)
+            tile_dist = dist[a, b]
+            if d > tile_dist[r]:
+                continue
+
+            # Other portals of the same tile
+            tile = get_tile(a, b)
+            new = d + tile.distances[r]
+            better = np.flatnonzero(new < tile_dist)
+            tile_dist[better] = new[better]
+            for r2, d2 in zip(better.tolist(), new[better].tolist()):
+                heapq.heappush(heap, (d2, a, b, r2))
+
+            # Neighbouring cells in other tiles, which are portals if passable
+            i, j = divmod(int(tile.portals[r]), tile.grid.n_y)
+            i, j = a * t + i, b * t + j
+            for di, dj, w in _STEPS:
+                ni, nj = i + di, j + dj
+                if not (0 <= ni < n_x and 0 <= nj < n_y) or (ni // t, nj // t) == (a, b):
+                    continue
+                if not passable(ni, nj) or \
+                        (di and dj and not (passable(i + di, j) and passable(i, j + dj))):
+                    continue
+                na, nb = ni // t, nj // t
+                neighbour = get_tile(na, nb)
+                r2 = int(neighbour.rows[(ni % t) * neighbour.grid.n_y + nj % t])
+                if (na, nb) not in dist:
+                    dist[na, nb] = np.full(len(neighbour.portals), np.inf)
+                if d + w < dist[na, nb][r2]:
+                    dist[na, nb][r2] = d + w
+                    heapq.heappush(heap, (d + w, na, nb, r2))
+
+        return dist
+
+    def _assemble(self,
+                  window: bim_grid.FloorGrid,
+                  values: Callable[[int, int], np.ndarray],
+                  fill) -> np.ndarray:
+        """Combine per-tile arrays into an array covering a window of the floor grid."""
+        t = self.tile_size
+        i0, j0 = window.i0, window.j0
+        result = np.full(window.shape, fill)
+        for a in range(i0 // t, (i0 + window.n_x - 1) // t + 1):
+            for b in range(j0 // t, (j0 + window.n_y - 1) // t + 1):
+                tile_values = values(a, b)
+                i_start, i_stop = max(i0, a * t), min(i0 + window.n_x, (a + 1) * t)
+                j_start, j_stop = max(j0, b * t), min(j0 + window.n_y, (b + 1) * t)
+                result[i_start - i0:i_stop - i0, j_start - j0:j_stop - j0] = \
+                    tile_values[i_start - a * t:i_stop - a * t, j_start - b * t:j_stop - b * t]
+        return result
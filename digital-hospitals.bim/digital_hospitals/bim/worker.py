@@ -0,0 +1,71 @@
+"""Worker process for distributed BIM computations.
+
+Run with `python -m digital_hospitals.bim.worker`. Each worker claims tasks from the MongoDB task
+queue (see `digital_hospitals.bim.tasks`) until it receives SIGINT or SIGTERM.
+"""
+
+import argparse
+import multiprocessing
+import signal
+import threading
+
+from digital_hospitals.bim import db as bim_db
+from digital_hospitals.bim import tasks
+from digital_hospitals.bim.lazy import warm_up
+
+
+def run_worker(lease: float = tasks.LEASE_SECONDS,
+               poll: float = tasks.POLL_SECONDS,
+               preload: bool = True):
+    """Run a single worker in the current process until SIGINT or SIGTERM is received.
+    A task already in progress is finished first.
+
+    If `preload` is set, the geometry and graph libraries are imported before the worker
+    claims its first task."""
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    if preload:
+        warm_up()
+
+    client = bim_db.connect()
+    try:
+        tasks.work(client[bim_db.DB_NAME], stop, lease=lease, poll=poll)
+    finally:
+        client.close()
+
+
+def main():
+    """Command-line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--processes', type=int, default=1,
+                        help='Number of worker processes to start (default: 1).')
+    parser.add_argument('--lease', type=float, default=tasks.LEASE_SECONDS,
+                        help='Task lease duration in seconds.')
+    parser.add_argument('--poll', type=float, default=tasks.POLL_SECONDS,
+                        help='Time between checks of an empty task queue, in seconds.')
+    parser.add_argument('--no-preload', dest='preload', action='store_false',
+                        help='Import the geometry libraries on the first task instead of '
+                        'on startup.')
+    args = parser.parse_args()
+
+    if args.processes == 1:
+        run_worker(args.lease, args.poll, args.preload)
+        return
+
+    procs = [multiprocessing.Process(target=run_worker,
+                                     args=(args.lease, args.poll, args.preload))
+             for _ in range(args.processes)]
+    for p in procs:
+        p.start()
+
+    # Children receive SIGINT from the terminal themselves; forward SIGTERM to them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: [p.terminate() for p in procs])
+    for p in procs:
+        p.join()
+
+
+if __name__ == '__main__':
+    main()
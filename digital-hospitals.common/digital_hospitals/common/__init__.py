@@ -1,4 +1,5 @@
 """Common values used for the histopathology project."""
+import functools
 import os
 from typing import Literal
 
@@ -14,7 +15,21 @@ MONGODB_PORT = 27017
 MONGODB_USER = 'root'
 MONGODB_TIMEOUT = 5000  # ms
 PASSWORD_PATH = f"{'/run' if check_docker else '..'}/secrets/mongo-root-pw"
-MONGODB_PASSWORD = open(PASSWORD_PATH, 'r', encoding='utf-8').read()
+
+
+@functools.cache
+def mongodb_password() -> str:
+    """The MongoDB root password, read from `PASSWORD_PATH` on first use."""
+    with open(PASSWORD_PATH, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def __getattr__(name: str):
+    # `MONGODB_PASSWORD` is still available as a module constant, but the secrets file is only
+    # read when it is first accessed, not when this module is imported.
+    if name == 'MONGODB_PASSWORD':
+        return mongodb_password()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 ### FASTAPI ###
@@ -1,9 +1,16 @@
 """Developer frontpage for Digital Hospitals project."""
 
+import json
 import os
+import time
+import urllib.parse
+import urllib.request
+from datetime import datetime
 
+import dash
 import dash_mantine_components as dmc
-from dash import Dash
+import plotly.graph_objects as go
+from dash import Dash, Input, Output, State, callback, dcc, no_update
 from dash_compose import composition
 
 IFM_LINK = "https://www.ifm.eng.cam.ac.uk/research/dial/research-projects/"\
@@ -11,6 +18,22 @@ IFM_LINK = "https://www.ifm.eng.cam.ac.uk/research/dial/research-projects/"\
 
 README_URL = f"https://github.com/{os.environ['DH_GITHUB']}/blob/main/README.md"
 
+BIM_API_URL = os.environ.get('BIM_API_URL', 'http://localhost:8000')
+"""Base URL of the BIM service, for the performance dashboard."""
+
+REFRESH_MS = 5000
+"""Refresh interval of the performance dashboard."""
+
+HISTORY_SECONDS = 3600
+"""Jobs finished in this many seconds before the dashboard is opened are shown."""
+
+MAX_POINTS = 500
+"""Maximum number of points kept in each trace of the dashboard graphs."""
+
+JOB_STAGES = ['parse', 'store_model', 'compute']
+LATENCY_PATHS = ['/latest', '/query']
+LATENCY_PERCENTILES = ['p50', 'p95', 'p99']
+
 
 def color(col: str, variant: int) -> str:
     return dmc.DEFAULT_THEME['colors'][col][variant]
@@ -60,7 +83,7 @@ def layout(main_content: dmc.AppShellMain):
 @composition
 def body():
     """The main div of the webpage."""
-    with dmc.AppShellMain([], miw=600, px='xl') as content:
+    with dmc.Box() as content:
         yield dmc.Title("Developer Portal", order=2, mb='sm',
                         style={'text-decoration-line': 'underline'})
         with dmc.List():
@@ -73,6 +96,11 @@ def body():
                     "Project documentation - main", href="/dev/specs/", refresh=True, target='_self'
                 )
                 yield ' (warning - unstable and subject to change)'
+            with dmc.ListItem():
+                yield dmc.Anchor(
+                    "BIM service performance dashboard",
+                    href=dash.get_relative_path('/performance')
+                )
         yield dmc.Title('API documentaton (Swagger)', order=3)
         with dmc.List():
             with dmc.ListItem():
@@ -87,10 +115,127 @@ def body():
     return content
 
 
+def durations_figure() -> go.Figure:
+    """Empty figure for the stage durations of finished BIM jobs, one trace per stage."""
+    fig = go.Figure(
+        [go.Scatter(x=[], y=[], name=stage, mode='markers') for stage in JOB_STAGES],
+        layout={'title': 'BIM job durations by stage', 'xaxis_title': 'Finished',
+                'yaxis_title': 'Duration (s)', 'template': 'plotly_dark'}
+    )
+    return fig
+
+
+def latency_figure() -> go.Figure:
+    """Empty figure for the latency percentiles of BIM endpoints, one trace per endpoint and
+    percentile."""
+    fig = go.Figure(
+        [
+            go.Scatter(x=[], y=[], name=f'{path} {pct}', mode='lines')
+            for path in LATENCY_PATHS for pct in LATENCY_PERCENTILES
+        ],
+        layout={'title': 'BIM endpoint latency', 'xaxis_title': 'Time',
+                'yaxis_title': 'Latency (ms)', 'template': 'plotly_dark'}
+    )
+    return fig
+
+
+@composition
+def performance():
+    """Performance dashboard for the BIM service."""
+    with dmc.Box() as content:
+        yield dmc.Title("BIM Service Performance", order=2, mb='sm',
+                        style={'text-decoration-line': 'underline'})
+        yield dmc.Anchor("Back to developer portal", href=dash.get_relative_path('/'))
+        with dmc.SimpleGrid(cols=2, my='md'):
+            with dmc.Paper(p='md', withBorder=True):
+                yield dmc.Text("Job queue depth", size="sm", c='dimmed')
+                yield dmc.Text("-", id='perf-queue-depth', size="xl", fw=700)
+            with dmc.Paper(p='md', withBorder=True):
+                yield dmc.Text("Grid cache hit rate", size="sm", c='dimmed')
+                yield dmc.Text("-", id='perf-cache', size="xl", fw=700)
+        yield dmc.Text(id='perf-status', c='red')
+        yield dcc.Graph(id='perf-durations', figure=durations_figure())
+        yield dcc.Graph(id='perf-latency', figure=latency_figure())
+        yield dcc.Interval(id='perf-interval', interval=REFRESH_MS)
+        yield dcc.Store(id='perf-cursor')
+    return content
+
+
+def fetch_metrics(since: float) -> dict:
+    """Get the metrics of the BIM service, for jobs finished after `since`."""
+    query = urllib.parse.urlencode({'since': since})
+    with urllib.request.urlopen(f'{BIM_API_URL}/metrics?{query}', timeout=5) as response:
+        return json.load(response)
+
+
+@callback(
+    Output('perf-queue-depth', 'children'),
+    Output('perf-cache', 'children'),
+    Output('perf-durations', 'extendData'),
+    Output('perf-latency', 'extendData'),
+    Output('perf-cursor', 'data'),
+    Output('perf-status', 'children'),
+    Input('perf-interval', 'n_intervals'),
+    State('perf-cursor', 'data')
+)
+def refresh_performance(_, cursor):
+    """Fetch the metrics for jobs finished since the previous refresh and append them to the
+    graphs, instead of redrawing the full history."""
+    if cursor is None:
+        cursor = time.time() - HISTORY_SECONDS
+    try:
+        metrics = fetch_metrics(cursor)
+    except (OSError, ValueError) as exc:
+        return no_update, no_update, no_update, no_update, cursor, \
+            f'BIM service unavailable: {exc}'
+
+    cache = metrics['cache']
+    if cache is None:
+        cache_text = 'Disabled'
+    elif cache['hits'] + cache['misses'] == 0:
+        cache_text = '-'
+    else:
+        cache_text = f"{cache['hits'] / (cache['hits'] + cache['misses']):.1%}"
+
+    jobs = metrics['jobs']
+    if jobs:
+        finished = [datetime.fromtimestamp(job['finished_ts']).isoformat() for job in jobs]
+        durations = (
+            {
+                'x': [finished for _ in JOB_STAGES],
+                'y': [[job['timings'].get(stage) for job in jobs] for stage in JOB_STAGES]
+            },
+            list(range(len(JOB_STAGES))),
+            MAX_POINTS
+        )
+    else:
+        durations = no_update
+
+    now = datetime.now().isoformat()
+    latency = (
+        {
+            'x': [[now] for _ in LATENCY_PATHS for _ in LATENCY_PERCENTILES],
+            'y': [
+                [metrics['latency'][path][pct]]
+                for path in LATENCY_PATHS for pct in LATENCY_PERCENTILES
+            ]
+        },
+        list(range(len(LATENCY_PATHS) * len(LATENCY_PERCENTILES))),
+        MAX_POINTS
+    )
+
+    return metrics['queue_depth'], cache_text, durations, latency, metrics['cursor'], ''
+
+
 app = Dash(
     __name__,
     title='Developer Portal',
-    url_base_pathname='/dev/'
+    url_base_pathname='/dev/',
+    use_pages=True,
+    pages_folder=''
 )
-app.layout = layout(body())
+dash.register_page('home', path='/', title='Developer Portal', layout=body())
+dash.register_page('performance', path='/performance', title='BIM Service Performance',
+                   layout=performance())
+app.layout = layout(dmc.AppShellMain([dash.page_container], miw=600, px='xl'))
 server = app.server
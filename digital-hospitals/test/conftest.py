@@ -0,0 +1,15 @@
+import pytest
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """The BIM service's database, backed by an in-memory MongoDB stand-in. All connections
+    opened with `digital_hospitals.bim.db.connect()` share it."""
+    mongomock = pytest.importorskip('mongomock')
+    from digital_hospitals.bim import db as bim_db
+
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(client, 'close', lambda: None)
+    monkeypatch.setattr(bim_db, 'connect', lambda: client)
+    bim_db._MODEL_CACHE.clear()  # pylint: disable=protected-access
+    return client[bim_db.DB_NAME]
@@ -0,0 +1,263 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('fastapi')
+pytest.importorskip('httpx')
+ntx = pytest.importorskip('networkx')
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from digital_hospitals.bim import app, loadtest, models, tasks  # noqa: E402
+from digital_hospitals.bim import db as bim_db  # noqa: E402
+from digital_hospitals.bim.events import notifier  # noqa: E402
+
+UPLOAD = b'test model\n'
+
+
+@pytest.fixture
+def model():
+    return loadtest.synthetic_model(floors=2, rooms=2)
+
+
+@pytest.fixture
+def params(model):
+    return loadtest.request_params(model)
+
+
+@pytest.fixture
+def client(mongo, model, monkeypatch, tmp_path):
+    monkeypatch.setattr(app, 'SPOOL_DIR', tmp_path / 'spool')
+    monkeypatch.setattr(app, 'distributed', False)
+    monkeypatch.setattr(app, 'distance_fields',
+                        app.DistanceFieldsCache(app.DISTANCE_FIELDS_MAX_BYTES))
+    # Uploads of UPLOAD use this model instead of being parsed as IFC files
+    bim_db.store_model(mongo, hashlib.sha256(UPLOAD).hexdigest(), model)
+    with TestClient(app.api) as test_client:
+        yield test_client
+
+
+def submit(client, params, upload: bytes = UPLOAD) -> str:
+    response = client.post('/', files={'file': ('model.ifc', upload)},
+                           data={'form_data': json.dumps(params)})
+    assert response.status_code == 202
+    return response.json()['id']
+
+
+def sse_events(text: str) -> list[tuple[str, dict]]:
+    events = []
+    for block in text.split('\n\n'):
+        lines = dict(line.split(': ', 1) for line in block.splitlines() if ': ' in line)
+        if 'event' in lines:
+            events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+
+def test_job_result(client, params):
+    job_id = submit(client, params)  # The background task runs before the response is returned
+
+    result = client.get('/query', params={'id': job_id}).json()
+    assert result['status'] == 'OK', result['err_msg']
+    assert len(result['graph']['nodes']) == len(params['door_list'])
+    assert client.get('/latest').json()['graph'] == result['graph']
+
+
+@pytest.mark.parametrize('form_data', ['{"door_list": 5}', '{"door_list": [', '[]'])
+def test_invalid_form_data_rejected(client, mongo, form_data):
+    response = client.post('/', files={'file': ('model.ifc', UPLOAD)},
+                           data={'form_data': form_data})
+    assert response.status_code == 422
+    assert response.json()['detail'][0]['loc'] is not None
+    assert mongo['results'].count_documents({}) == 0
+
+
+def test_job_stream_ends_with_result(client, params):
+    job_id = submit(client, params)
+
+    with client.stream('GET', '/stream', params={'id': job_id}) as response:
+        events = sse_events(response.read().decode())
+    assert [e for e, _ in events] == ['result']
+    assert events[0][1]['status'] == 'OK'
+    assert events[0][1]['graph'] is not None
+
+
+def test_job_stream_pushes_updates(client, mongo):
+    _id = mongo['results'].insert_one(
+        app.BimResult(status='Running', requested_ts=app.now(), progress=0.0).model_dump()
+    ).inserted_id
+
+    def finish():
+        mongo['results'].update_one({'_id': _id}, {'$set': {'status': 'OK', 'progress': None,
+                                                            'graph': app.EXAMPLE_GRAPH}})
+        notifier.publish(str(_id))
+
+    # Finish the job once the stream has sent the initial status
+    timer = threading.Timer(0.5, finish)
+    timer.start()
+    try:
+        with client.stream('GET', '/stream', params={'id': str(_id)}) as response:
+            events = sse_events(response.read().decode())
+    finally:
+        timer.cancel()
+    assert [e for e, _ in events] == ['status', 'result']
+    assert events[1][1]['graph'] == app.EXAMPLE_GRAPH
+
+
+def test_distance_fields_warmed_by_job(client, params, model, monkeypatch):
+    submit(client, params)
+    assert {floor for _, floor, _ in app.distance_fields._fields} == set(model.elevations)
+
+    # Queries are answered from the warmed fields without loading the model
+    def fail(*args):
+        raise AssertionError('distance fields recomputed')
+
+    monkeypatch.setattr(app.distance_fields, '_compute', fail)
+    result = client.get('/distance', params={'floor': 'Level 0', 'x': 2.0, 'y': 5.0}).json()
+    assert result['doors'] == params['door_list']
+    assert all(t is not None for t in result['times'][0])
+
+
+def test_distance_continues_along_latest_graph(client, params):
+    job_id = submit(client, params)
+    graph = ntx.node_link_graph(client.get('/query', params={'id': job_id}).json()['graph'])
+
+    # Inside room S0 of Level 0, whose only door is Level 0:S0; Level 1 is reached by the lift
+    points = [{'floor': 'Level 0', 'x': 1.0, 'y': 1.0}, {'floor': 'Level 0', 'x': -5.0, 'y': 1.0}]
+    result = client.post('/distance', json={'points': points}).json()
+    times = dict(zip(result['doors'], result['times'][0]))
+    to_door = times['Level 0:S0']
+    for door, seconds in times.items():
+        assert seconds == pytest.approx(
+            to_door + ntx.shortest_path_length(graph, 'Level 0:S0', door, weight='weight')
+        ), door
+    assert all(t is None for t in result['times'][1])  # Outside the floor
+
+
+def test_distance_fields_evicted_by_size(client, params):
+    submit(client, params)
+    keys = list(app.distance_fields._fields)
+    size = app.distance_fields._bytes // len(keys)  # The floors are identical
+
+    fields = app.DistanceFieldsCache(max_bytes=size)
+    for key in keys:
+        fields.get(*key)
+    assert list(fields._fields) == keys[-1:]
+    assert fields._bytes == size
+
+
+def test_distance_fields_too_large(client, params, monkeypatch):
+    monkeypatch.setattr(app, 'distance_fields', app.DistanceFieldsCache(max_bytes=1))
+    submit(client, params)
+    assert client.get('/latest').status_code == 200
+    assert not app.distance_fields._fields
+
+    response = client.get('/distance', params={'floor': 'Level 0', 'x': 2.0, 'y': 5.0})
+    assert response.status_code == 503
+    assert 'BIM_DISTANCE_MAX_BYTES' in response.json()['detail']
+
+
+def test_metrics_include_worker_cache_stats(client, mongo):
+    assert client.get('/metrics').json()['cache'] is None  # BIM_CACHE_DIR is not set
+
+    mongo[tasks.WORKER_STATS].insert_many([{'_id': 'w1', 'hits': 3, 'misses': 1},
+                                           {'_id': 'w2', 'hits': 2, 'misses': 4}])
+    assert client.get('/metrics').json()['cache'] == {'hits': 5, 'misses': 5}
+
+
+def test_stale_spool_files_deleted_on_startup(mongo, monkeypatch, tmp_path):
+    monkeypatch.setattr(app, 'SPOOL_DIR', tmp_path)
+    stale, recent = tmp_path / 'stale.ifc', tmp_path / 'recent.ifc'
+    stale.write_bytes(UPLOAD)
+    recent.write_bytes(UPLOAD)
+    old = time.time() - app.SPOOL_MAX_AGE_SECONDS - 60
+    os.utime(stale, (old, old))
+
+    with TestClient(app.api):
+        pass
+    assert not stale.exists()
+    assert recent.exists()
+
+
+@pytest.fixture(params=[False, True], ids=['local', 'distributed'])
+def workers(request, client, mongo, monkeypatch):
+    """Run jobs in the API process, or in worker threads with `BIM_DISTRIBUTED` set."""
+    if not request.param:
+        yield
+        return
+    monkeypatch.setattr(app, 'distributed', True)
+    stop = threading.Event()
+    worker = threading.Thread(target=tasks.work, args=(mongo, stop),
+                              kwargs={'worker': 'w1', 'poll': 0.01})
+    worker.start()
+    yield
+    stop.set()
+    worker.join()
+
+
+def test_unchanged_floors_reused(client, mongo, workers, params):
+    def version(name: bytes, change=None):
+        model = loadtest.synthetic_model(floors=2, rooms=2)
+        if change is not None:
+            change(model)
+        return name, bim_db.store_model(mongo, hashlib.sha256(name).hexdigest(), model)
+
+    def run(upload, model, job_params) -> set[str]:
+        result = client.get('/query', params={'id': submit(client, job_params, upload)}).json()
+        assert result['status'] == 'OK', result['err_msg']
+        request = app.BimRequestParams.model_validate(job_params)
+        expected = models.logical_graph(model, request.door_list, request.extra_paths)
+        graph = ntx.node_link_graph(result['graph'])
+        assert sorted(map(sorted, graph.edges)) == sorted(map(sorted, expected.edges))
+        for u, v, weight in expected.edges(data='weight'):
+            assert graph.edges[u, v]['weight'] == pytest.approx(weight)
+        return set(result['reused_floors'])
+
+    def move_wall(model):  # Partition wall between the rooms of Level 1
+        model.walls.loc[model.walls.wall_name == 'Level 1:P1S', ['x0', 'x1']] += 0.5
+
+    def move_door(model):
+        model.doors.loc[model.doors.door_name == 'Level 0:N1', ['x0', 'x1']] -= 0.5
+
+    v1, v2, v3 = version(b'v1'), version(b'v2', move_wall), version(b'v3', move_door)
+    assert run(*v1, params) == set()
+    assert run(*v1, params) == {'Level 0', 'Level 1'}
+    assert run(*v2, params) == {'Level 0'}
+    assert run(*v3, params) == {'Level 1'}
+
+    # Changing the doors of interest on one floor only invalidates that floor
+    fewer_doors = params | {'door_list': [d for d in params['door_list'] if d != 'Level 1:N1']}
+    assert run(*v1, fewer_doors) == {'Level 0'}
+
+
+def test_stale_jobs_failed_on_startup(client, mongo):
+    def running(age: float):
+        return mongo['results'].insert_one(
+            app.BimResult(status='Running', requested_ts=app.now() - age).model_dump()
+        ).inserted_id
+
+    stale, recent = running(tasks.JOB_TIMEOUT_SECONDS + 60), running(60)
+    app.prepare_db()
+
+    doc = mongo['results'].find_one({'_id': stale})
+    assert doc['status'] == 'Error' and doc['err_msg'] == app.STALE_JOB_MESSAGE
+    assert doc['finished_at'] is not None  # Expires with the other finished jobs
+    assert mongo['results'].find_one({'_id': recent})['status'] == 'Running'
+    assert client.get('/metrics').json()['queue_depth'] == 1
+
+
+def test_warm_up_failure_logged(client, params, monkeypatch, caplog):
+    def fail(*args):
+        raise RuntimeError('warm-up failed')
+
+    expired = []
+    monkeypatch.setattr(app.distance_fields, 'warm_up', fail)
+    monkeypatch.setattr(bim_db, 'expire_unused', expired.append)
+    submit(client, params)
+
+    assert 'warm-up failed' in caplog.text
+    assert client.get('/latest').status_code == 200
+    assert len(expired) == 1  # Unused models are still deleted
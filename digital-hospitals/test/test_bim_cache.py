@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+
+from digital_hospitals.bim.cache import GridCache, cached
+
+
+def test_put_and_get(tmp_path):
+    cache = GridCache(tmp_path)
+    cache.put('a', np.arange(10))
+    assert np.array_equal(cache.get('a'), np.arange(10))
+    assert cache.get('b') is None
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = GridCache(tmp_path, max_bytes=2500)  # Room for two entries of 100 floats
+    cache.put('a', np.zeros(100))
+    cache.put('b', np.zeros(100))
+    # Make 'a' the most recently used entry
+    os.utime(cache._path('b'), (0, 0))  # pylint: disable=protected-access
+    cache.get('a')
+
+    cache.put('c', np.zeros(100))
+    assert cache.get('a') is not None
+    assert cache.get('b') is None
+    assert cache.get('c') is not None
+
+
+def test_put_larger_than_budget(tmp_path):
+    cache = GridCache(tmp_path, max_bytes=100)
+    cache.put('old', np.zeros(10))
+
+    array = cache.put('k', np.zeros(1000))
+    assert np.array_equal(array, np.zeros(1000))
+    assert cache.get('old') is None
+
+    # The oversized entry is evicted by the next one
+    cache.put('next', np.zeros(10))
+    assert cache.get('k') is None
+
+
+def test_cached_without_cache_computes(tmp_path):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return np.arange(3)
+
+    for cache in (None, None, GridCache(tmp_path), GridCache(tmp_path)):
+        assert np.array_equal(cached(cache, 'a', compute), np.arange(3))
+    assert len(calls) == 3  # The second GridCache loads the array stored by the first
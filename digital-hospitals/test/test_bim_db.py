@@ -0,0 +1,168 @@
+from datetime import datetime, timedelta, timezone
+
+import bson
+import numpy as np
+import pandas as pd
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+from digital_hospitals.bim import db as bim_db
+from digital_hospitals.bim import loadtest, models
+
+ntx = pytest.importorskip('networkx')
+
+
+def latest_ts(mongo):
+    return mongo[bim_db.RESULTS_LATEST].find_one({'_id': bim_db.LATEST_ID})['requested_ts']
+
+
+def test_update_latest_keeps_newer_result(mongo):
+    assert bim_db.update_latest(mongo, {'requested_ts': 2.0})
+    assert not bim_db.update_latest(mongo, {'requested_ts': 1.0})
+    assert bim_db.update_latest(mongo, {'requested_ts': 3.0})
+    assert latest_ts(mongo) == 3.0
+
+
+def test_update_latest_retries_after_concurrent_insert(mongo, monkeypatch):
+    collection = mongo[bim_db.RESULTS_LATEST]
+    replace_one = collection.replace_one
+
+    def insert_first(query, doc, upsert=False):
+        # Another job inserts the first latest result between our filter and our insert
+        if upsert:
+            collection.insert_one({'_id': bim_db.LATEST_ID, 'requested_ts': 1.0})
+            raise DuplicateKeyError('E11000')
+        return replace_one(query, doc)
+
+    monkeypatch.setattr(type(collection), 'replace_one',
+                        lambda self, *args, **kwargs: insert_first(*args, **kwargs))
+    assert bim_db.update_latest(mongo, {'requested_ts': 2.0})
+    assert latest_ts(mongo) == 2.0
+
+
+def test_ensure_ttl_index_changes_expiry(mongo, monkeypatch):
+    commands = []
+    monkeypatch.setattr(type(mongo), 'command', lambda self, *args, **kwargs: commands.append(
+        (args, kwargs)))
+    results = mongo[bim_db.RESULTS]
+
+    bim_db.ensure_ttl_index(results, 'finished_at', 60)
+    bim_db.ensure_ttl_index(results, 'finished_at', 60)
+    assert not commands
+
+    bim_db.ensure_ttl_index(results, 'finished_at', 120)
+    assert commands == [(('collMod', bim_db.RESULTS),
+                         {'index': {'keyPattern': {'finished_at': 1}, 'expireAfterSeconds': 120}})]
+
+
+def test_ensure_indexes_continues_after_failure(mongo, monkeypatch, caplog):
+    def fail(*args, **kwargs):
+        raise RuntimeError('collMod failed')
+
+    monkeypatch.setattr(bim_db, 'ensure_ttl_index', fail)
+    mongo[bim_db.RESULTS_LATEST].insert_one({'requested_ts': 1.0})  # Legacy latest result
+    bim_db.ensure_indexes(mongo)
+
+    assert 'collMod failed' in caplog.text
+    assert latest_ts(mongo) == 1.0
+
+
+def test_expire_unused_keeps_latest_model(mongo):
+    model = loadtest.synthetic_model(floors=1, rooms=1)
+    for model_id in ('old', 'latest', 'recent'):
+        bim_db.store_model(mongo, model_id, model)
+    bim_db.store_floor_graph(mongo, 'old-floor', ntx.Graph())
+    bim_db.store_floor_graph(mongo, 'recent-floor', ntx.Graph())
+    bim_db.update_latest(mongo, {'requested_ts': 1.0, 'model_id': 'latest'})
+
+    long_ago = datetime.now(timezone.utc) - timedelta(seconds=bim_db.MODEL_RETENTION_SECONDS + 60)
+    mongo[bim_db.MODELS].update_many({'_id': {'$in': ['old', 'latest']}},
+                                     {'$set': {'last_used': long_ago}})
+    mongo[bim_db.FLOOR_GRAPHS].update_one({'_id': 'old-floor'}, {'$set': {'last_used': long_ago}})
+    bim_db.expire_unused(mongo)
+
+    assert sorted(doc['_id'] for doc in mongo[bim_db.MODELS].find()) == ['latest', 'recent']
+    assert [doc['_id'] for doc in mongo[bim_db.FLOOR_GRAPHS].find()] == ['recent-floor']
+
+
+def test_loading_updates_last_used(mongo):
+    bim_db.store_model(mongo, 'm1', loadtest.synthetic_model(floors=1, rooms=1))
+    bim_db.store_floor_graph(mongo, 'f1', ntx.Graph())
+    long_ago = datetime(2000, 1, 1)
+    for collection in (bim_db.MODELS, bim_db.FLOOR_GRAPHS):
+        mongo[collection].update_many({}, {'$set': {'last_used': long_ago}})
+
+    bim_db.load_model(mongo, 'm1')
+    bim_db.load_floor_graphs(mongo, {'Level 0': 'f1'})
+    for collection in (bim_db.MODELS, bim_db.FLOOR_GRAPHS):
+        assert mongo[collection].find_one()['last_used'] > long_ago
+
+
+def assert_round_trip(model: models.BimModel) -> models.BimModel:
+    loaded = models.BimModel.from_npz(model.to_npz())
+    assert loaded.elevations == model.elevations
+    for table, name_col in (('doors', 'door_name'), ('walls', 'wall_name')):
+        expected, actual = getattr(model, table), getattr(loaded, table)
+        assert list(actual[name_col]) == list(expected[name_col])
+        assert list(actual.floor) == list(expected.floor)
+        assert isinstance(actual.floor.dtype, pd.CategoricalDtype)
+        for col in models.COORD_COLUMNS:
+            assert actual[col].dtype == np.float32
+            np.testing.assert_array_equal(actual[col], expected[col].astype(np.float32))
+    return loaded
+
+
+def test_npz_round_trip():
+    model = loadtest.synthetic_model(floors=3, rooms=2)
+    model.walls.loc[0, 'x0'] = 0.1  # Not exactly representable as float32
+    loaded = assert_round_trip(model)
+    assert list(loaded.walls.floor.cat.categories) == sorted(model.elevations)
+
+
+def test_npz_smaller_than_legacy_document():
+    model = loadtest.synthetic_model(floors=5, rooms=200)
+    legacy = bson.encode({'data': models.BimData.from_obj(model).model_dump()})
+    assert len(model.to_npz()) < len(legacy) / 2
+
+
+def test_npz_floor_without_walls_or_doors():
+    model = loadtest.synthetic_model(floors=1, rooms=1)
+    model.elevations['Roof'] = 8.0
+    assert_round_trip(model)
+
+
+def test_npz_floor_without_elevation():
+    model = loadtest.synthetic_model(floors=2, rooms=1)
+    del model.elevations['Level 1']
+    loaded = assert_round_trip(model)
+    assert 'Level 1' in set(loaded.doors.floor)
+
+
+def test_npz_empty_frames():
+    empty = {col: [] for col in ['floor'] + models.COORD_COLUMNS}
+    model = models.BimModel(elevations={'L': 0.0},
+                            doors=pd.DataFrame({'door_name': []} | empty),
+                            walls=pd.DataFrame({'wall_name': []} | empty))
+    loaded = assert_round_trip(model)
+    assert len(loaded.doors) == 0 and len(loaded.walls) == 0
+
+
+def test_npz_missing_names():
+    model = loadtest.synthetic_model(floors=1, rooms=1)
+    model.doors.loc[0, 'door_name'] = None
+    model.walls.loc[0, 'wall_name'] = np.nan
+    loaded = models.BimModel.from_npz(model.to_npz())
+    assert pd.isna(loaded.doors.door_name[0])
+    assert pd.isna(loaded.walls.wall_name[0])
+    assert list(loaded.doors.door_name[1:]) == list(model.doors.door_name[1:])
+
+
+def test_load_legacy_json_model(mongo):
+    model = loadtest.synthetic_model(floors=2, rooms=1)
+    mongo[bim_db.MODELS].insert_one(
+        {'_id': 'legacy', 'data': models.BimData.from_obj(model).model_dump()}
+    )
+    loaded = bim_db.load_model(mongo, 'legacy')
+    assert loaded.elevations == model.elevations
+    pd.testing.assert_frame_equal(loaded.doors, model.doors)
+    pd.testing.assert_frame_equal(loaded.walls, model.walls)
@@ -0,0 +1,86 @@
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from digital_hospitals.bim import loadtest, models
+from digital_hospitals.bim.cache import GridCache
+
+ntx = pytest.importorskip('networkx')
+
+
+def random_floor(seed: int, n_walls: int = 30, size: float = 20.0) -> models.BimModel:
+    """A square floor with randomly placed walls, and a door in each of the first ten."""
+    rng = np.random.default_rng(seed)
+    t = 0.2
+    walls = [
+        dict(wall_name='S', x0=0, x1=size, y0=0, y1=t),
+        dict(wall_name='N', x0=0, x1=size, y0=size - t, y1=size),
+        dict(wall_name='W', x0=0, x1=t, y0=0, y1=size),
+        dict(wall_name='E', x0=size - t, x1=size, y0=0, y1=size),
+    ]
+    doors = []
+    for k in range(n_walls):
+        x, y = rng.uniform(0, size - 2, 2)
+        length = rng.uniform(1.5, 8)
+        if k % 2 == 0:
+            walls.append(dict(wall_name=f'w{k}', x0=x, x1=min(x + length, size), y0=y, y1=y + t))
+            door = dict(x0=x + 0.2, x1=x + 1.0, y0=y, y1=y + t)
+        else:
+            walls.append(dict(wall_name=f'w{k}', x0=x, x1=x + t, y0=y, y1=min(y + length, size)))
+            door = dict(x0=x, x1=x + t, y0=y + 0.2, y1=y + 1.0)
+        if k < 10:
+            doors.append(dict(door_name=f'd{k}', **door))
+
+    return models.BimModel(
+        elevations={'L': 0.0},
+        doors=pd.DataFrame(doors).assign(floor='L', z0=0.0),
+        walls=pd.DataFrame(walls).assign(floor='L', z0=0.0)
+    )
+
+
+FLOORS = {
+    'corridor': (loadtest.synthetic_model(floors=1, rooms=3), 'Level 0'),
+    'random0': (random_floor(0), 'L'),
+    'random1': (random_floor(1), 'L'),
+}
+
+
+@pytest.mark.parametrize('floor', FLOORS)
+def test_door_distances_match_shortest_path(floor):
+    model, level = FLOORS[floor]
+    doors = list(model.doors.door_name)
+    s_model = models.ShapelyModel(model, level, doors)
+
+    for i, from_door in enumerate(doors[:4]):
+        distances = s_model.door_distances(from_door, doors[i + 1:])
+        for to_door in doors[i + 1:]:
+            try:
+                expected, _ = s_model.shortest_path(from_door, to_door)
+            except ntx.NetworkXNoPath:
+                expected = math.inf
+            assert distances[to_door] == pytest.approx(expected, abs=1e-4), (from_door, to_door)
+
+
+@pytest.mark.parametrize('floor', FLOORS)
+@pytest.mark.parametrize('tile_size', [5, 16, 64])
+@pytest.mark.parametrize('cached', [False, True])
+def test_tiled_door_distances_match_untiled(floor, tile_size, cached, monkeypatch, tmp_path):
+    monkeypatch.setenv('BIM_TILE_MAX_BYTES', str(64 << 10))  # Forces tiles to be evicted
+    model, level = FLOORS[floor]
+    doors = list(model.doors.door_name)
+    untiled = models.ShapelyModel(model, level, doors)
+    cache = GridCache(tmp_path) if cached else None
+
+    for run in range(1 + cached):  # Computes, then loads from the cache
+        tiled = models.ShapelyModel(model, level, doors, cache=cache, tile_size=tile_size)
+        for i, from_door in enumerate(doors[:4]):
+            expected = untiled.door_distances(from_door, doors[i + 1:])
+            distances = tiled.door_distances(from_door, doors[i + 1:])
+            assert distances.keys() == expected.keys()
+            for to_door, distance in expected.items():
+                assert distances[to_door] == pytest.approx(distance, rel=1e-5), \
+                    (run, from_door, to_door)
+    if cached:
+        assert cache.hits > 0
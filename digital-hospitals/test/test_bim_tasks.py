@@ -0,0 +1,135 @@
+import threading
+
+import pytest
+
+from digital_hospitals.bim import db as bim_db
+from digital_hospitals.bim import loadtest, models, tasks
+from digital_hospitals.bim.cache import GridCache
+
+ntx = pytest.importorskip('networkx')
+
+
+@pytest.fixture
+def model(mongo):
+    """A synthetic model, stored in the database as 'm1'."""
+    return bim_db.store_model(mongo, 'm1', loadtest.synthetic_model(floors=2, rooms=2))
+
+
+@pytest.fixture
+def door_list(model):
+    return list(model.doors.door_name)
+
+
+def assert_same_graph(g1, g2):
+    assert sorted(map(sorted, g1.edges)) == sorted(map(sorted, g2.edges))
+    for u, v, weight in g1.edges(data='weight'):
+        assert g2.edges[u, v]['weight'] == pytest.approx(weight)
+
+
+def test_workers_compute_logical_graph(mongo, model, door_list):
+    extra_paths = [models.Path(path=(door_list[0], door_list[-1]), duration_seconds=30,
+                               required_assets=['lift'])]
+    stop = threading.Event()
+    workers = [threading.Thread(target=tasks.work, args=(mongo, stop),
+                                kwargs={'worker': f'w{i}', 'poll': 0.01})
+               for i in range(3)]
+    for w in workers:
+        w.start()
+    try:
+        graph = tasks.logical_graph(mongo, 'job', 'm1', model, door_list, extra_paths)
+    finally:
+        stop.set()
+        for w in workers:
+            w.join()
+
+    assert_same_graph(graph, models.logical_graph(model, door_list, extra_paths))
+    assert mongo[tasks.TASKS].count_documents({}) == 0
+
+
+def test_expired_lease_is_reclaimed(mongo, model, door_list):
+    tasks.submit(mongo, 'job', 'm1', model, door_list)
+    first = tasks.claim(mongo, 'w1', lease=0.0)  # Expires immediately
+
+    second = tasks.claim(mongo, 'w2')
+    assert second['_id'] == first['_id']
+    assert second['attempts'] == 2
+    assert not tasks.renew(mongo, first['_id'], 'w1')
+
+    # The first worker's late result is ignored
+    tasks.complete(mongo, first['_id'], 'w1', ntx.Graph())
+    assert mongo[tasks.TASKS].find_one({'_id': first['_id']})['status'] == 'Running'
+
+
+def test_task_failing_max_attempts_fails_job(mongo, model, door_list):
+    tasks.submit(mongo, 'job', 'm1', model, door_list, batch_size=100)
+    for attempt in range(tasks.MAX_ATTEMPTS):
+        doc = tasks.claim(mongo, 'w1')
+        assert doc['attempts'] == attempt + 1
+        tasks.fail(mongo, doc['_id'], 'w1', 'boom')
+
+    with pytest.raises(RuntimeError, match='boom'):
+        tasks.wait(mongo, 'job', poll=0.01)
+    assert mongo[tasks.TASKS].count_documents({}) == 0
+
+
+def test_wait_merges_partial_graphs_by_level(mongo, model, door_list):
+    tasks.submit(mongo, 'job', 'm1', model, door_list, batch_size=1)
+    while (doc := tasks.claim(mongo, 'w1')) is not None:
+        tasks.complete(mongo, doc['_id'], 'w1', tasks.run_task(mongo, tasks.Task(**doc)))
+
+    graphs = tasks.wait(mongo, 'job', poll=0.01)
+    assert set(graphs) == set(models.included_levels(model, door_list))
+    for level, graph in graphs.items():
+        s_model = models.ShapelyModel(model, level, door_list)
+        assert_same_graph(graph, s_model.logical_graph())
+
+
+def test_wait_times_out_without_workers(mongo, model, door_list):
+    tasks.submit(mongo, 'job', 'm1', model, door_list)
+    with pytest.raises(TimeoutError, match='No worker claimed a task'):
+        tasks.wait(mongo, 'job', poll=0.01, timeout=0.05)
+    assert mongo[tasks.TASKS].count_documents({}) == 0
+
+
+def test_workers_report_cache_stats(mongo, model, door_list, monkeypatch, tmp_path):
+    cache = GridCache(tmp_path)
+    monkeypatch.setattr(tasks, 'default_cache', lambda: cache)
+    assert tasks.worker_cache_stats(mongo) is None
+
+    stop = threading.Event()
+    worker = threading.Thread(target=tasks.work, args=(mongo, stop),
+                              kwargs={'worker': 'w1', 'poll': 0.01})
+    worker.start()
+    try:
+        tasks.logical_graph(mongo, 'job1', 'm1', model, door_list, [])
+        first = tasks.worker_cache_stats(mongo)
+        tasks.logical_graph(mongo, 'job2', 'm1', model, door_list, [])
+    finally:
+        stop.set()
+        worker.join()
+
+    # The second job only loads the arrays computed by the first
+    assert first[1] > 0
+    assert tasks.worker_cache_stats(mongo) == (cache.hits, cache.misses)
+    assert cache.hits > first[0] and cache.misses == first[1]
+    assert mongo[tasks.WORKER_STATS].count_documents({}) == 1
+
+
+def test_orphaned_tasks_deleted(mongo, model, door_list):
+    running = str(mongo[bim_db.RESULTS].insert_one({'status': 'Running'}).inserted_id)
+    failed = str(mongo[bim_db.RESULTS].insert_one({'status': 'Error'}).inserted_id)
+    for job_id in (running, failed, 'deleted-job'):
+        tasks.submit(mongo, job_id, 'm1', model, door_list)
+
+    tasks.delete_orphaned(mongo)
+    assert set(mongo[tasks.TASKS].distinct('job_id')) == {running}
+
+
+def test_tasks_expire(mongo, model, door_list):
+    tasks.ensure_indexes(mongo)
+    ttl = [index for index in mongo[tasks.TASKS].list_indexes()
+           if dict(index['key']) == {'created_at': 1}]
+    assert ttl[0]['expireAfterSeconds'] == int(tasks.JOB_TIMEOUT_SECONDS)
+
+    tasks.submit(mongo, 'job', 'm1', model, door_list)
+    assert all(doc['created_at'] is not None for doc in mongo[tasks.TASKS].find())
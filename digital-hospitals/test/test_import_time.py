@@ -0,0 +1,38 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+IMPORT_TIME_BUDGET = 1.0
+"""Maximum time to import the BIM API module in a fresh interpreter, in seconds."""
+
+HEAVY_MODULES = ['ifcopenshell', 'natsort', 'networkx', 'pandas', 'shapely']
+
+IMPORT_SCRIPT = """\
+import json, sys, time
+start = time.perf_counter()
+import digital_hospitals.bim.app
+print(json.dumps({'seconds': time.perf_counter() - start, 'modules': list(sys.modules)}))
+"""
+
+
+def import_bim_app() -> dict:
+    """Import the BIM API module in a new interpreter and report the time taken and the
+    modules loaded."""
+    result = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT],
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def test_bim_app_import_is_lazy():
+    pytest.importorskip('fastapi')
+    modules = import_bim_app()['modules']
+    assert [m for m in HEAVY_MODULES if m in modules] == []
+
+
+def test_bim_app_import_time():
+    pytest.importorskip('fastapi')
+    # Best of three, to reduce noise from other processes
+    seconds = min(import_bim_app()['seconds'] for _ in range(3))
+    assert seconds < IMPORT_TIME_BUDGET, f'Import took {seconds:.2f}s'